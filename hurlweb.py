@@ -20,6 +20,9 @@ from web.package import Package, PackageLog, PackageFile
 from web.root import Root
 from web.api import API
 from web.source import Source
+from web.cache import PageCache
+from web.markup import ReadmeRenderer
+from repo.archive import ArchiveCache
 
 # Check if we have xapian
 try:
@@ -40,6 +43,8 @@ except ImportError:
 
 if HAVE_ARCH2CAKE:
     from web.abs import Abs
+    from repo.arch import CakefileCache
+    from repo.abs import AbsCatalog
 
 def error_page_404(status, message, traceback, version):
     return "<h1>Error 404</h1><p>File not found</p>"
@@ -50,34 +55,77 @@ cherrypy.config.update({ "error_page.404": error_page_404 })
 cherrypy.config.update(confpath)
 
 # Initialise repo and templates
-repo = HurlGitRepo(cherrypy.config["hurl"]["repo"])
+repo = HurlGitRepo(cherrypy.config["hurl"]["repo"],
+        cherrypy.config["hurl"].get("cache.cakefiles", 4096),
+        cherrypy.config["hurl"].get("cache.trees", 64*1024*1024),
+        cherrypy.config["hurl"].get("cache.objects", 128*1024*1024))
 lookup = TemplateLookup(directories=[os.path.join(directory, "templates")])
 access = HurlAccess(cherrypy.config["hurl"]["userdb"],
                     cherrypy.config["hurl"]["commentdb"],
                     cherrypy.config["hurl"]["authkeys"])
 index = None
 
+# Render every request from a single snapshot of the refs
+def pin_refs():
+    repo.pin_refs()
+    cherrypy.request.hooks.attach("on_end_request", repo.unpin_refs)
+
+cherrypy.tools.pin_refs = cherrypy.Tool("on_start_resource", pin_refs)
+cherrypy.config.update({ "tools.pin_refs.on": True })
+
+# Initialise the archive cache
+archives, sendfile = None, None
+
+if "archive.cache" in cherrypy.config["hurl"]:
+    archives = ArchiveCache(cherrypy.config["hurl"]["archive.cache"],
+            cherrypy.config["hurl"].get("archive.cache_size", 1024*1024*1024))
+
+    if "archive.sendfile" in cherrypy.config["hurl"]:
+        sendfile = (cherrypy.config["hurl"]["archive.sendfile"],
+                    cherrypy.config["hurl"].get("archive.sendfile_prefix", ""))
+
 # Initialise index
 if HAVE_XAPIAN and "index" in cherrypy.config["hurl"]:
     index = HurlXapianIndex(cherrypy.config["hurl"]["index"],
-            cherrypy.config["hurl"].get("index.expire", 30))
+            cherrypy.config["hurl"].get("index.expire", 30),
+            cherrypy.config["hurl"].get("index.cache", 1024),
+            cherrypy.config["hurl"].get("index.check_interval", 1.0))
+
+# Initialise the rendered page cache
+pages = PageCache(cherrypy.config["hurl"].get("cache.pages", 32*1024*1024))
+readmes = ReadmeRenderer(repo,
+        cherrypy.config["hurl"].get("cache.readmes", 8*1024*1024))
 
 # Mount trees
-cherrypy.tree.mount(Root(repo, lookup, index), "/", confpath)
+cherrypy.tree.mount(Root(repo, lookup, pages, index), "/", confpath)
 
-cherrypy.tree.mount(Package(repo, lookup), "/package", confpath)
-cherrypy.tree.mount(PackageLog(repo, lookup), "/package-log", confpath)
+cherrypy.tree.mount(Package(repo, lookup, pages, readmes), "/package",
+        confpath)
+cherrypy.tree.mount(PackageLog(repo, lookup, pages), "/package-log",
+        confpath)
 cherrypy.tree.mount(PackageFile(repo, lookup), "/package-file", confpath)
 
-cherrypy.tree.mount(Branch(repo, lookup), "/branch", confpath)
-cherrypy.tree.mount(BranchLog(repo, lookup), "/branch-log", confpath)
+cherrypy.tree.mount(Branch(repo, lookup, pages, readmes), "/branch",
+        confpath)
+cherrypy.tree.mount(BranchLog(repo, lookup, pages), "/branch-log", confpath)
 
-cherrypy.tree.mount(Source(repo, lookup), "/source", confpath)
-cherrypy.tree.mount(API(repo, lookup, index, access), "/api", confpath)
+cherrypy.tree.mount(Source(repo, lookup, archives, sendfile,
+        cherrypy.config["hurl"].get("archive.levels"),
+        cherrypy.config["hurl"].get("archive.workers", 1)), "/source", confpath)
+cherrypy.tree.mount(API(repo, lookup, index, access, pages), "/api",
+        confpath)
 
 # Autoconverted packages
 if HAVE_ARCH2CAKE:
-    cherrypy.tree.mount(Abs(repo, lookup), "/abs", confpath)
+    cakefiles = CakefileCache(
+            cherrypy.config["hurl"].get("cakefile.cache_size", 1024),
+            cherrypy.config["hurl"].get("cakefile.cache"))
+
+    abs_catalog = AbsCatalog(cherrypy.config["arch"]["absroot"],
+            cherrypy.config["arch"].get("poll_interval", 30))
+
+    cherrypy.tree.mount(Abs(repo, lookup, abs_catalog, cakefiles), "/abs",
+            confpath)
 
 # Search
 if index:
@@ -0,0 +1,272 @@
+import os
+import stat
+import time
+import logging
+import threading
+
+try:
+    scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+def list_dir(path):
+    """
+        Get the sorted (name, is_dir) entries of a directory, or None
+        if it doesn't exist.
+    """
+    try:
+        if scandir is not None:
+            entries = [(entry.name, entry.is_dir()) for entry in scandir(path)]
+        else:
+            entries = [(name, os.path.isdir(os.path.join(path, name)))
+                       for name in os.listdir(path)]
+    except OSError:
+        return None
+
+    entries.sort()
+    return entries
+
+def dir_mtime(path):
+    """
+        Get the mtime of a directory, or None if it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return st.st_mtime if stat.S_ISDIR(st.st_mode) else None
+
+class AbsCatalog(object):
+    def __init__(self, absroot, interval=30, watch=True):
+        """
+            In-memory listing of the repositories, packages and files
+            in an ABS tree, kept up to date in the background so
+            listing them doesn't have to touch the disk.
+            @param absroot: The root of the ABS tree.
+            @param interval: Check the tree for changes this often, in
+                seconds, when inotify isn't available. Never if None.
+            @param watch: Watch for changes with inotify if pyinotify
+                is installed.
+        """
+        self.absroot = absroot
+        self.interval = interval
+        self.lock = threading.Lock()
+
+        # repo -> {package: [files]}, replaced instead of modified
+        self.repos = {}
+
+        # directory -> mtime when it was last listed
+        self.mtimes = {}
+
+        self.scan()
+
+        if watch and pyinotify is not None:
+            self.start_inotify()
+        elif interval is not None:
+            thread = threading.Thread(target=self.run_poll)
+            thread.daemon = True
+            thread.start()
+
+    def repositories(self):
+        """
+            Get the sorted names of all repositories.
+        """
+        return sorted(self.repos)
+
+    def packages(self, repo):
+        """
+            Get the sorted names of all packages in a repository, or
+            None if there's no such repository.
+        """
+        packages = self.repos.get(repo)
+        if packages is None:
+            return None
+        return sorted(packages)
+
+    def files(self, repo, package):
+        """
+            Get the sorted names of the files of a package, or None if
+            there's no such package.
+        """
+        return self.repos.get(repo, {}).get(package)
+
+    def list_package(self, path):
+        """
+            List the files of a package directory.
+        """
+        self.mtimes[path] = dir_mtime(path)
+
+        entries = list_dir(path)
+        if entries is None:
+            return None
+        return [name for name, is_dir in entries]
+
+    def list_repo(self, path):
+        """
+            List all packages in a repository directory.
+        """
+        self.mtimes[path] = dir_mtime(path)
+
+        entries = list_dir(path)
+        if entries is None:
+            return None
+
+        packages = {}
+        for name, is_dir in entries:
+            if is_dir:
+                files = self.list_package(os.path.join(path, name))
+                if files is not None:
+                    packages[name] = files
+        return packages
+
+    def scan(self):
+        """
+            List the whole tree.
+        """
+        with self.lock:
+            self.mtimes = {self.absroot: dir_mtime(self.absroot)}
+            repos = {}
+
+            for name, is_dir in list_dir(self.absroot) or []:
+                if is_dir:
+                    packages = self.list_repo(os.path.join(self.absroot, name))
+                    if packages is not None:
+                        repos[name] = packages
+
+            self.repos = repos
+
+    def rescan_root(self):
+        """
+            Pick up repositories that were added to or removed from
+            the tree.
+        """
+        with self.lock:
+            self.mtimes[self.absroot] = dir_mtime(self.absroot)
+            names = [name for name, is_dir in list_dir(self.absroot) or []
+                     if is_dir]
+
+        for name in set(names) - set(self.repos):
+            self.rescan_repo(name)
+        for name in set(self.repos) - set(names):
+            self.rescan_repo(name)
+
+    def rescan_repo(self, repo):
+        """
+            List a repository again.
+        """
+        path = os.path.join(self.absroot, repo)
+
+        with self.lock:
+            # Forget packages that might be gone
+            for key in [key for key in self.mtimes
+                        if key == path or key.startswith(path+os.sep)]:
+                del self.mtimes[key]
+
+            packages = self.list_repo(path)
+            repos = dict(self.repos)
+
+            if packages is None:
+                repos.pop(repo, None)
+                self.mtimes.pop(path, None)
+            else:
+                repos[repo] = packages
+
+            self.repos = repos
+
+    def rescan_package(self, repo, package):
+        """
+            List the files of a package again.
+        """
+        if repo not in self.repos:
+            return self.rescan_repo(repo)
+
+        path = os.path.join(self.absroot, repo, package)
+
+        with self.lock:
+            files = self.list_package(path)
+            packages = dict(self.repos.get(repo, {}))
+
+            if files is None:
+                packages.pop(package, None)
+                self.mtimes.pop(path, None)
+            else:
+                packages[package] = files
+
+            repos = dict(self.repos)
+            repos[repo] = packages
+            self.repos = repos
+
+    def changed(self, path):
+        """
+            Handle a change to a path in the tree.
+        """
+        rel = os.path.relpath(path, self.absroot).split(os.sep)
+
+        if rel[0] in (".", ".."):
+            self.rescan_root()
+        elif len(rel) == 1:
+            self.rescan_repo(rel[0])
+        else:
+            self.rescan_package(rel[0], rel[1])
+
+    def poll(self):
+        """
+            Rescan the directories whose mtime changed.
+        """
+        if dir_mtime(self.absroot) != self.mtimes.get(self.absroot):
+            self.rescan_root()
+
+        for repo in list(self.repos):
+            path = os.path.join(self.absroot, repo)
+            if dir_mtime(path) != self.mtimes.get(path):
+                self.rescan_repo(repo)
+                continue
+
+            for package in list(self.repos.get(repo, ())):
+                path = os.path.join(self.absroot, repo, package)
+                if dir_mtime(path) != self.mtimes.get(path):
+                    self.rescan_package(repo, package)
+
+    def run_poll(self):
+        """
+            Keep polling the tree for changes.
+        """
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("ABS poll error.")
+
+    def start_inotify(self):
+        """
+            Watch the tree for changes with inotify.
+        """
+        catalog = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                try:
+                    catalog.changed(event.pathname)
+                except Exception:
+                    logging.exception("ABS watch error.")
+
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+               pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+
+        manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self.notifier.daemon = True
+        self.notifier.start()
+
+        manager.add_watch(self.absroot, mask, rec=True, auto_add=True)
@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import pickle
+import hashlib
+import multiprocessing
+from arch2cake import arch2cake, parse_pkgbuild, dump_cakefile
+
+from repo.cache import LRUCache
+
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+def convert_pkgbuild(path):
+    """
+        Convert a PKGBUILD to a Cakefile.
+    """
+    output = StringIO.StringIO()
+
+    # Parse
+    with open(path, "r") as fd:
+        data = parse_pkgbuild(fd)
+
+    # Convert
+    data = arch2cake(data)
+
+    # Dump
+    dump_cakefile(data, output)
+
+    return output.getvalue()
+
+def file_key(path):
+    """
+        Get a key identifying the current contents of a file.
+    """
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_mtime, st.st_size)
+
+class CakefileCache(object):
+    def __init__(self, maxsize=1024, path=None):
+        """
+            Cache of Cakefiles converted from PKGBUILDs, keyed on the
+            identity of the PKGBUILD so changed files get reconverted.
+            @param maxsize: The maximum amount of Cakefiles to keep
+                in memory.
+            @param path: Directory to persist conversions to, so they
+                survive restarts. Only kept in memory if None.
+        """
+        self.memory = LRUCache(maxsize)
+        self.path = path
+
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        """
+            Get the file a conversion is persisted to.
+        """
+        return os.path.join(self.path, hashlib.sha1(repr(key)).hexdigest())
+
+    def lookup(self, key):
+        """
+            Get a converted Cakefile from memory or disk, or None if
+            it wasn't converted yet.
+        """
+        data = self.memory.get(key)
+        if data is not None or self.path is None:
+            return data
+
+        try:
+            with open(self.filename(key), "rb") as fd:
+                stored, data = pickle.load(fd)
+        except Exception:
+            return None
+
+        if stored != key:
+            return None
+
+        self.memory.put(key, data)
+        return data
+
+    def put(self, key, data):
+        """
+            Add a converted Cakefile.
+        """
+        self.memory.put(key, data)
+
+        if self.path is None:
+            return
+
+        filename = self.filename(key)
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+
+        try:
+            with open(tmp, "wb") as fd:
+                pickle.dump((key, data), fd, 2)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            # Not being able to persist only costs a conversion later
+            pass
+
+    def get(self, path):
+        """
+            Get the Cakefile converted from a PKGBUILD, converting it
+            only if it changed since it was last converted.
+        """
+        key = file_key(path)
+
+        data = self.lookup(key)
+        if data is None:
+            data = convert_pkgbuild(path)
+            self.put(key, data)
+        return data
+
+    def prune(self, keys):
+        """
+            Remove persisted conversions other than those of keys.
+        """
+        if self.path is None:
+            return
+
+        keep = set(os.path.basename(self.filename(key)) for key in keys)
+
+        for name in os.listdir(self.path):
+            if name not in keep:
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+            Get the usage counters of the in-memory cache.
+        """
+        return self.memory.stats()
+
+def find_pkgbuilds(absroot):
+    """
+        Find the PKGBUILD of every package in an ABS tree, as
+        (repo, package, path) tuples.
+    """
+    for repo in sorted(os.listdir(absroot)):
+        reporoot = os.path.join(absroot, repo)
+        if not os.path.isdir(reporoot):
+            continue
+
+        for package in sorted(os.listdir(reporoot)):
+            path = os.path.join(reporoot, package, "PKGBUILD")
+            if os.path.isfile(path):
+                yield repo, package, path
+
+def convert_job(job):
+    """
+        Convert one package in a worker process. Gives back the job
+        with the Cakefile, the error if it failed and the time taken.
+    """
+    repo, package, path, key = job
+    start = time.time()
+
+    try:
+        data, error = convert_pkgbuild(path), None
+    except Exception as e:
+        data, error = None, "%s: %s" % (type(e).__name__, e)
+
+    return job, data, error, time.time()-start
+
+def convert_tree(absroot, cache, workers=None, force=False):
+    """
+        Convert every package in an ABS tree into the cache using a
+        pool of processes, printing the time taken by every package
+        and the ones that failed.
+        @param workers: Amount of processes, defaults to one per CPU.
+        @param force: Also convert packages that are already cached.
+    """
+    jobs, keys, cached = [], [], 0
+
+    for repo, package, path in find_pkgbuilds(absroot):
+        key = file_key(path)
+        keys.append(key)
+
+        if not force and cache.lookup(key) is not None:
+            cached += 1
+        else:
+            jobs.append((repo, package, path, key))
+
+    print("Converting %d packages, %d already cached" % (len(jobs), cached))
+
+    pool = multiprocessing.Pool(workers)
+    start = time.time()
+    failures = []
+
+    try:
+        for job, data, error, taken in pool.imap_unordered(convert_job, jobs):
+            name = "%s/%s" % (job[0], job[1])
+
+            if error is None:
+                cache.put(job[3], data)
+                print("%8.3fs %s" % (taken, name))
+            else:
+                failures.append((name, error))
+                print("%8.3fs %s FAILED" % (taken, name))
+    finally:
+        pool.close()
+        pool.join()
+
+    taken = time.time()-start
+
+    for name, error in failures:
+        print("FAILED %s: %s" % (name, error))
+
+    print("%d converted, %d failed in %.3fs" % (len(jobs)-len(failures),
+        len(failures), taken))
+
+    # Drop conversions of files that changed or went away
+    cache.prune(keys)
+
+def main():
+    from repo.config import load_config
+
+    if len(sys.argv) < 2:
+        print("USAGE: %s ABSROOT [WORKERS] [force]" % sys.argv[0])
+        return
+
+    config = load_config()
+    if "cakefile.cache" not in config:
+        print("No cakefile.cache configured, nothing to convert into.")
+        return
+
+    workers = int(sys.argv[2]) if len(sys.argv) >= 3 else None
+    force = len(sys.argv) >= 4 and sys.argv[3] == "force"
+
+    cache = CakefileCache(path=config["cakefile.cache"])
+    convert_tree(sys.argv[1], cache, workers, force)
+
+if __name__ == '__main__':
+    main()
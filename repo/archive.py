@@ -0,0 +1,646 @@
+import os
+import re
+import bz2
+import zlib
+import stat
+import struct
+import hashlib
+import tarfile
+import logging
+import threading
+import collections
+import dulwich
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Amount of blob data fed to the compressor at a time
+CHUNK_SIZE = 64*1024
+
+# Cached archive file names, as folder.digest.ext
+ARCHIVE_NAME = re.compile(r"^(.*)\.[0-9a-f]{40}\.")
+
+class GzipCompressor(object):
+    def __init__(self, level=9, mtime=0):
+        """
+            Compressor producing a gzip stream, with a fixed timestamp
+            in its header so the output only depends on the input.
+            @param level: The compression level, 1 to 9.
+            @param mtime: The timestamp to put in the header.
+        """
+        self.zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                     zlib.DEF_MEM_LEVEL, 0)
+        self.crc = zlib.crc32("") & 0xffffffff
+        self.size = 0
+
+        # Magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self.header = "\037\213\010\000" + struct.pack("<L", int(mtime)) + \
+                      "\000\377"
+
+    def compress(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+
+        out = self.zobj.compress(data)
+
+        if self.header is not None:
+            out, self.header = self.header + out, None
+        return out
+
+    def flush(self):
+        out = self.zobj.flush() + struct.pack("<LL", self.crc,
+                                              self.size & 0xffffffff)
+
+        if self.header is not None:
+            out, self.header = self.header + out, None
+        return out
+
+def gzip_compress(data, level=9, mtime=0):
+    """
+        Compress data into a complete gzip member.
+    """
+    compressor = GzipCompressor(level, mtime)
+    return compressor.compress(data) + compressor.flush()
+
+Format = collections.namedtuple("Format", "compressor compress mime level")
+
+MODES = {
+    "tar.gz": Format(GzipCompressor, gzip_compress,
+                     "application/x-tar-gz", 9),
+    "tar.bz2": Format(lambda level, mtime: bz2.BZ2Compressor(level),
+                      lambda data, level, mtime: bz2.compress(data, level),
+                      "application/x-tar-bz2", 9),
+}
+
+if lzma is not None:
+    MODES["tar.xz"] = Format(
+        lambda level, mtime: lzma.LZMACompressor(preset=level),
+        lambda data, level, mtime: lzma.compress(data, preset=level),
+        "application/x-xz", 6)
+
+if zstandard is not None:
+    MODES["tar.zst"] = Format(
+        lambda level, mtime: zstandard.ZstdCompressor(level=level).compressobj(),
+        lambda data, level, mtime: zstandard.ZstdCompressor(level=level).compress(data),
+        "application/zstd", 19)
+
+# Size of the independently compressed blocks when compressing in parallel
+BLOCK_SIZE = 1024*1024
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(workers):
+    """
+        Get the shared pool of compression threads of a certain size.
+    """
+    with POOLS_LOCK:
+        if workers not in POOLS:
+            POOLS[workers] = ThreadPool(workers)
+        return POOLS[workers]
+
+class ParallelCompressor(object):
+    def __init__(self, compress, workers):
+        """
+            Compressor that splits its input in blocks which are
+            compressed independently on a pool of threads. The blocks
+            are output in order as one valid multi-member stream.
+            @param compress: Function compressing one block into a
+                complete member.
+            @param workers: The amount of threads to use.
+        """
+        self.compress_block = compress
+        self.pool = get_pool(workers)
+        self.maxpending = 2*workers
+
+        self.pending = collections.deque()
+        self.submitted = False
+        self.buf, self.buflen = [], 0
+
+    def submit(self, block):
+        self.pending.append(self.pool.apply_async(self.compress_block,
+                                                  (block,)))
+        self.submitted = True
+
+    def compress(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+
+        if self.buflen < BLOCK_SIZE:
+            return ""
+
+        # Always cut at the same offsets, so the output is reproducible
+        data = "".join(self.buf)
+        start = 0
+        while len(data)-start >= BLOCK_SIZE:
+            self.submit(data[start:start+BLOCK_SIZE])
+            start += BLOCK_SIZE
+
+        data = data[start:]
+        self.buf, self.buflen = [data] if data else [], len(data)
+
+        out = []
+        while len(self.pending) > self.maxpending:
+            out.append(self.pending.popleft().get())
+        return "".join(out)
+
+    def flush(self):
+        if self.buflen or not self.submitted:
+            self.submit("".join(self.buf))
+            self.buf, self.buflen = [], 0
+
+        out = []
+        while self.pending:
+            out.append(self.pending.popleft().get())
+        return "".join(out)
+
+class ChunkSink(object):
+    def __init__(self, compressor=None):
+        """
+            Write-only file object that keeps what is written to it
+            until it is drained, optionally compressing it first.
+        """
+        self.compressor = compressor
+        self.chunks = []
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+
+        if data:
+            self.chunks.append(data)
+
+    def close(self):
+        """
+            Flush the compressor.
+        """
+        if self.compressor is not None:
+            self.chunks.append(self.compressor.flush())
+            self.compressor = None
+
+    def drain(self):
+        """
+            Get and forget everything written so far.
+        """
+        data = "".join(self.chunks) if self.chunks else ""
+        self.chunks = []
+        return data
+
+def tar_info(name, mode, mtime):
+    """
+        Get a tar header for a file with the permissions and owner
+        normalised from its git mode.
+    """
+    info = tarfile.TarInfo(name=name)
+    info.mtime = int(mtime)
+    info.mode = 0o755 if mode & 0o111 else 0o644
+    info.uid, info.gid = 0, 0
+    info.uname, info.gname = "", ""
+    return info
+
+def tar_member(tarf, info, chunks, sink):
+    """
+        Add a member to a streaming tar archive from an iterable of data
+        chunks, yielding the output as it is produced instead of
+        buffering the whole member.
+    """
+    tarf.addfile(tarinfo=info)
+
+    for data in chunks:
+        tarf.fileobj.write(data)
+
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+
+    # Pad to a full block, like tarfile does itself
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        tarf.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tarf.offset += blocks * tarfile.BLOCKSIZE
+
+def tar_blob(tarf, info, data, sink):
+    """
+        Add a member with data from a string to a streaming tar archive.
+    """
+    chunks = (data[start:start+CHUNK_SIZE]
+              for start in range(0, info.size, CHUNK_SIZE))
+
+    return tar_member(tarf, info, chunks, sink)
+
+def tar_path(tarf, path, arcname, sink):
+    """
+        Add a file or directory from disk to a streaming tar archive,
+        yielding the output as it is produced.
+    """
+    info = tarf.gettarinfo(path, arcname)
+
+    if info.isreg():
+        with open(path, "rb") as fd:
+            chunks = iter(lambda: fd.read(CHUNK_SIZE), "")
+            for chunk in tar_member(tarf, info, chunks, sink):
+                yield chunk
+    else:
+        tarf.addfile(tarinfo=info)
+
+    if info.isdir():
+        for name in sorted(os.listdir(path)):
+            for chunk in tar_path(tarf, os.path.join(path, name),
+                                  os.path.join(arcname, name), sink):
+                yield chunk
+
+def tar_tree(tarf, folder, repo, tree, sink, mtime):
+    """
+        Add all files in a tree to a streaming tar archive in sorted
+        order, yielding the output as it is produced.
+    """
+    for mode, filename, ident in sorted(tree.entries(),
+                                        key=lambda entry: entry[1]):
+        # Straight from the store, a download shouldn't push out the
+        # objects the cache keeps for pages
+        obj = repo.object_store[ident]
+        name = os.path.join(folder, filename)
+
+        if isinstance(obj, dulwich.objects.Blob):
+            blob = obj.as_raw_string()
+            info = tar_info(name, mode, mtime)
+
+            if stat.S_ISLNK(mode):
+                info.type = tarfile.SYMTYPE
+                info.linkname = blob
+                info.mode = 0o777
+                info.size = 0
+            else:
+                info.size = len(blob)
+
+            for chunk in tar_blob(tarf, info, blob, sink):
+                yield chunk
+        elif isinstance(obj, dulwich.objects.Tree):
+            for chunk in tar_tree(tarf, name, repo, obj, sink, mtime):
+                yield chunk
+
+def stream_tree(repo, tree, folder, ext, mtime=0, level=None, workers=1):
+    """
+        Generate a compressed tar archive of a tree chunk by chunk.
+        The same arguments always produce the same bytes.
+        @param folder: The name of the folder the files are put under.
+        @param ext: The archive type, one of MODES.
+        @param mtime: The timestamp given to all files.
+        @param level: The compression level, defaults to the format's.
+        @param workers: Compress blocks on this many threads if more
+            than one.
+    """
+    compressor = get_compressor(ext, mtime, level, workers)
+    sink = ChunkSink(compressor)
+    tarf = tarfile.open(fileobj=sink, mode="w|", format=tarfile.GNU_FORMAT)
+
+    for chunk in tar_tree(tarf, folder, repo, tree, sink, mtime):
+        yield chunk
+
+    tarf.close()
+    sink.close()
+
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
+
+def get_compressor(ext, mtime=0, level=None, workers=1):
+    """
+        Get a compressor for an archive type.
+    """
+    fmt = MODES[ext]
+    level = fmt.level if level is None else level
+
+    if workers > 1:
+        return ParallelCompressor(
+            lambda data: fmt.compress(data, level, mtime), workers)
+    return fmt.compressor(level, mtime)
+
+def archive_key(tree, folder, ext, mtime=0, level=None, workers=1):
+    """
+        Get the name identifying the archive of a tree, which is
+        also used as its ETag.
+    """
+    level = MODES[ext].level if level is None else level
+
+    # Parallel compression gives different, but just as stable, output
+    digest = hashlib.sha1("%s\0%s\0%s\0%d\0%d\0%d" % (tree, folder, ext,
+        mtime, level, workers > 1)).hexdigest()
+
+    # Starts with the folder so archives of a package can be found
+    return folder+"."+digest
+
+def package_archive(repo, branch, package, ext, level=None, workers=1):
+    """
+        Get the (name, build) of the archive of a package in a branch,
+        or None if there's no such package. Build is a function returning
+        a generator of archive chunks.
+    """
+    tree = repo.get_package_tree(branch, package)
+    if tree is None:
+        return None
+
+    # The archive only depends on the tree, its name and the time
+    # the package last changed
+    folder = branch.replace("/", "-")+"-"+package
+    mtime = repo.get_package_mtime(branch, package) or 0
+    name = archive_key(tree.id, folder, ext, mtime, level, workers)
+
+    return name, lambda: stream_tree(repo, tree, folder, ext, mtime,
+                                     level, workers)
+
+class ArchiveCache(object):
+    def __init__(self, path, maxsize=1024*1024*1024):
+        """
+            On-disk cache of built archives, evicting the least recently
+            used ones when it grows too large.
+            @param path: The directory the archives are stored in.
+            @param maxsize: The maximum amount of bytes to store.
+                Defaults to 1GiB.
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+        # name -> Event, for archives that are being built
+        self.building = {}
+
+        # name -> size, least recently used first
+        self.files = collections.OrderedDict()
+        self.size = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Pick up archives from earlier runs, oldest built first
+        found = []
+        for name in os.listdir(path):
+            if ".tmp." in name:
+                continue
+
+            st = os.stat(os.path.join(path, name))
+            found.append((st.st_mtime, name, st.st_size))
+
+        for mtime, name, size in sorted(found):
+            self.files[name] = size
+            self.size += size
+
+    def filename(self, name, ext):
+        """
+            Get the path an archive is stored at.
+        """
+        return os.path.join(self.path, name+"."+ext)
+
+    def lookup(self, name, ext):
+        """
+            Get the path of an archive if it's in the cache and mark
+            it as recently used, or None if it isn't.
+        """
+        filename = self.filename(name, ext)
+        base = os.path.basename(filename)
+
+        # Use is only tracked in memory, the mtime stays the time the
+        # archive was built so it can be served as its Last-Modified
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            with self.lock:
+                if base in self.files:
+                    self.size -= self.files.pop(base)
+            return None
+
+        with self.lock:
+            if base in self.files:
+                self.files[base] = self.files.pop(base)
+            else:
+                # Built by another process
+                self.files[base] = size
+                self.size += size
+
+        return filename
+
+    def get(self, name, ext, build):
+        """
+            Get the path of an archive, building it if it's not cached.
+            Only one thread builds a certain archive, others wait for it.
+            @param build: Function returning a generator of archive chunks.
+        """
+        while True:
+            filename = self.lookup(name, ext)
+            if filename is not None:
+                return filename
+
+            with self.lock:
+                event = self.building.get(name)
+                builder = event is None
+
+                if builder:
+                    event = self.building[name] = threading.Event()
+
+            if not builder:
+                # Try again once it's built, or take over if it failed
+                event.wait()
+                continue
+
+            try:
+                return self.fill(name, ext, build)
+            finally:
+                with self.lock:
+                    del self.building[name]
+                event.set()
+
+    def get_file(self, name, ext, build):
+        """
+            Get an archive opened for reading, building it if it's not
+            cached. The file stays readable even if it's evicted.
+        """
+        while True:
+            filename = self.get(name, ext, build)
+
+            try:
+                return open(filename, "rb")
+            except IOError:
+                # Evicted in between, try again
+                continue
+
+    def fill(self, name, ext, build):
+        """
+            Build an archive and atomically publish it in the cache.
+        """
+        filename = self.filename(name, ext)
+        tmp = "%s.tmp.%d.%d" % (filename, os.getpid(),
+                                threading.current_thread().ident)
+
+        try:
+            with open(tmp, "wb") as fd:
+                for chunk in build():
+                    fd.write(chunk)
+            os.rename(tmp, filename)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        base = os.path.basename(filename)
+        size = os.path.getsize(filename)
+
+        with self.lock:
+            if base in self.files:
+                self.size -= self.files.pop(base)
+            self.files[base] = size
+            self.size += size
+
+            # Evict, but never the archive that was just built
+            evict = []
+            while self.size > self.maxsize and len(self.files) > 1:
+                old, oldsize = self.files.popitem(last=False)
+                self.size -= oldsize
+                evict.append(old)
+
+        for old in evict:
+            try:
+                os.unlink(os.path.join(self.path, old))
+            except OSError:
+                pass
+
+        return filename
+
+    def discard(self, match, keep=()):
+        """
+            Remove the archives built under some folder names.
+            @param match: Function telling if the archives of a folder
+                name should be removed.
+            @param keep: (name, ext) of archives to leave alone.
+        """
+        keep = set(self.filename(name, ext) for name, ext in keep)
+
+        for base in os.listdir(self.path):
+            filename = os.path.join(self.path, base)
+            found = ARCHIVE_NAME.match(base)
+
+            if found is None or not match(found.group(1)) or \
+               ".tmp." in base or filename in keep:
+                continue
+
+            with self.lock:
+                if base in self.files:
+                    self.size -= self.files.pop(base)
+
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+class ArchivePrewarmer(object):
+    def __init__(self, repo, archives, formats=("tar.gz",), levels=None,
+                 workers=1, maxqueue=256):
+        """
+            Builds the archives of changed packages into an archive cache
+            in the background.
+            @param formats: The archive types to build.
+            @param levels: Compression level per archive type.
+            @param workers: Compress archives on this many threads.
+            @param maxqueue: The amount of packages that can wait to be
+                built. Packages changing while the queue is full are
+                left to be built on request.
+        """
+        self.repo, self.archives = repo, archives
+        self.formats, self.levels = formats, levels or {}
+        self.workers = workers
+
+        self.queue = Queue.Queue(maxqueue)
+        self.lock = threading.Lock()
+
+        # Packages in the queue, so bursts are only built once
+        self.pending = set()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, branch, package):
+        """
+            Build the archives of a package soon.
+        """
+        with self.lock:
+            if (branch, package) in self.pending:
+                return
+
+            try:
+                self.queue.put_nowait((branch, package))
+            except Queue.Full:
+                return
+
+            self.pending.add((branch, package))
+
+    def discard(self, branch, package=None):
+        """
+            Drop the cached archives of a package, or of a whole branch.
+        """
+        prefix = branch.replace("/", "-")+"-"
+
+        if package is not None:
+            folder = prefix+package
+            self.archives.discard(lambda name: name == folder)
+            return
+
+        # Folders of branches like a/b-x start with the prefix of a/b too
+        others = [other.replace("/", "-")+"-"
+                  for other in self.repo.get_branches() if other != branch]
+        others = [other for other in others if other.startswith(prefix)]
+
+        self.archives.discard(lambda name: name.startswith(prefix) and
+            not any(name.startswith(other) for other in others))
+
+    def run(self):
+        while True:
+            branch, package = self.queue.get()
+
+            # Changes from now on need a new build
+            with self.lock:
+                self.pending.discard((branch, package))
+
+            try:
+                self.build(branch, package)
+            except Exception:
+                logging.exception("Prebuilding %s/%s failed." % (branch, package))
+
+    def build(self, branch, package):
+        """
+            Build all archives of a package and drop those of its
+            older trees.
+        """
+        current = []
+
+        for ext in MODES:
+            archive = package_archive(self.repo, branch, package, ext,
+                                      self.levels.get(ext), self.workers)
+            if archive is None:
+                return
+
+            name, build = archive
+            if ext in self.formats:
+                self.archives.get(name, ext, build)
+
+            # Formats that aren't prebuilt may have been built on request
+            current.append((name, ext))
+
+        folder = branch.replace("/", "-")+"-"+package
+        self.archives.discard(lambda name: name == folder, keep=current)
@@ -0,0 +1,145 @@
+import sys
+import time
+import yaml
+import hashlib
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+def counting_repo(path):
+    """
+        Open a repo that counts how many objects are read from it.
+    """
+    from repo.git import HurlGitRepo
+
+    class CountingRepo(HurlGitRepo):
+        reads = 0
+
+        def __getitem__(self, name):
+            self.reads += 1
+            return HurlGitRepo.__getitem__(self, name)
+
+    return CountingRepo(path)
+
+def unbatched_latest_versions(repo, packages):
+    """
+        Resolve a sync request one package at a time, without any
+        caching, the way it was done before batching.
+    """
+    updated = []
+    for branch, package, version in packages:
+        head = repo.get_head(branch)
+        if head is None:
+            continue
+
+        for entry in repo[repo[head].tree].entries():
+            if entry[1] == package:
+                tree = repo[entry[2]]
+                break
+        else:
+            continue
+
+        for entry in tree.entries():
+            if entry[1] == "Cakefile":
+                cakefile = yaml.load(repo[entry[2]].as_raw_string(),
+                                     Loader=Loader)
+                break
+        else:
+            continue
+
+        ver = str(cakefile["version"])+"-"+str(cakefile["release"])
+        if ver != str(version):
+            updated.append(package)
+    return updated
+
+def bench_sync(path, count=None):
+    """
+        Compare object reads and time taken of an unbatched and a
+        batched sync of every package in the repo.
+    """
+    repo = counting_repo(path)
+    packages = []
+
+    # Count every object access, not only the ones missing the cache
+    repo.object_cache.maxsize = 0
+
+    for branch in repo.get_branches():
+        for package in repo.packages_in_branch(branch):
+            packages.append((branch, package, "0-0"))
+
+    if count is not None:
+        packages = packages[:count]
+
+    print("Syncing %d packages" % len(packages))
+
+    for name, func in (("unbatched", unbatched_latest_versions),
+                       ("batched", type(repo).get_latest_versions)):
+        repo.cakefiles.clear()
+        repo.trees.clear()
+        repo.reads = 0
+
+        start = time.time()
+        func(repo, packages)
+        taken = time.time()-start
+
+        print("%-10s %8d object reads %10.3fs" % (name, repo.reads, taken))
+
+def bench_archives(path, count=None, ext="tar.gz"):
+    """
+        Build the archive of every package twice, checking that both
+        builds are byte-identical.
+    """
+    from repo.git import HurlGitRepo
+    from repo.archive import stream_tree
+
+    repo = HurlGitRepo(path)
+    packages = []
+
+    for branch in repo.get_branches():
+        for package in repo.packages_in_branch(branch):
+            packages.append((branch, package))
+
+    if count is not None:
+        packages = packages[:count]
+
+    print("Building %d %s archives twice" % (len(packages), ext))
+
+    start = time.time()
+    size, mismatches = 0, 0
+
+    for branch, package in packages:
+        tree = repo.get_package_tree(branch, package)
+        folder = branch.replace("/", "-")+"-"+package
+        mtime = repo.get_package_mtime(branch, package) or 0
+
+        digests = []
+        for i in range(2):
+            digest = hashlib.sha1()
+            for chunk in stream_tree(repo, tree, folder, ext, mtime):
+                digest.update(chunk)
+                size += len(chunk)
+            digests.append(digest.hexdigest())
+
+        if digests[0] != digests[1]:
+            mismatches += 1
+            print("MISMATCH %s/%s" % (branch, package))
+
+    taken = time.time()-start
+    print("%d mismatches, %d bytes in %.3fs" % (mismatches, size, taken))
+
+def main():
+    if len(sys.argv) < 3:
+        print("USAGE: %s REPO COMMAND [COUNT]" % sys.argv[0])
+        return
+
+    count = int(sys.argv[3]) if len(sys.argv) >= 4 else None
+
+    if sys.argv[2] == "sync":
+        bench_sync(sys.argv[1], count)
+    elif sys.argv[2] == "archives":
+        bench_archives(sys.argv[1], count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import threading
+import collections
+
+class LRUCache(object):
+    def __init__(self, maxsize, sizeof=None):
+        """
+            A thread-safe cache that evicts the least recently used
+            entries first.
+            @param maxsize: The maximum amount of entries to keep.
+            @param sizeof: Function giving the size of a value. If given,
+                maxsize bounds the total size of the values instead of
+                the amount of entries.
+        """
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # key -> (value, size)
+        self.entries = collections.OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """
+            Get an entry from the cache and mark it as recently used.
+        """
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+            Add an entry to the cache, evicting old entries if needed.
+            Values larger than the whole cache aren't kept.
+        """
+        size = self.sizeof(value) if self.sizeof is not None else 1
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            # Would only push out everything else, itself included
+            if size > self.maxsize:
+                return
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.maxsize and self.entries:
+                key, (value, size) = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+            Remove an entry from the cache.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+
+            self.size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        """
+            Remove all entries from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+            Get the usage counters of the cache.
+        """
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class ObjectCache(LRUCache):
+    def __init__(self, maxsize):
+        """
+            A thread-safe cache of decoded git objects, bounded by their
+            estimated size in bytes. Pinned objects are kept outside of
+            the LRU and are never evicted.
+            @param maxsize: The maximum amount of bytes to keep.
+        """
+        LRUCache.__init__(self, maxsize, sizeof=sizeof_object)
+
+        # key -> object, for pinned keys that were loaded
+        self.pinned = {}
+        self.pinned_keys = frozenset()
+
+        # type name -> [hits, misses]
+        self.types = {}
+
+    def count(self, obj, hit):
+        """
+            Count a hit or miss for the type of an object.
+        """
+        with self.lock:
+            if obj.type_name not in self.types:
+                self.types[obj.type_name] = [0, 0]
+            self.types[obj.type_name][0 if hit else 1] += 1
+
+    def peek(self, key):
+        """
+            Get an object without counting a hit or marking it used.
+        """
+        value = self.pinned.get(key)
+        if value is None:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value = entry[0]
+        return value
+
+    def get(self, key, default=None):
+        """
+            Get an object from the cache and mark it as recently used.
+        """
+        value = self.pinned.get(key)
+        if value is None:
+            value = LRUCache.get(self, key)
+            if value is None:
+                return default
+
+        self.count(value, True)
+        return value
+
+    def put(self, key, value):
+        """
+            Add an object that was missing from the cache.
+        """
+        self.count(value, False)
+
+        with self.lock:
+            if key in self.pinned_keys:
+                self.pinned[key] = value
+                return
+
+        LRUCache.put(self, key, value)
+
+    def pin(self, keys):
+        """
+            Replace the set of pinned keys. Objects that are no longer
+            pinned go back into the LRU.
+        """
+        keys = frozenset(keys)
+
+        with self.lock:
+            old = self.pinned
+            self.pinned_keys = keys
+
+        pinned = dict((key, old[key]) for key in keys if key in old)
+
+        for key in keys:
+            if key not in pinned:
+                value = LRUCache.pop(self, key)
+                if value is not None:
+                    pinned[key] = value
+
+        self.pinned = pinned
+
+        for key, value in old.items():
+            if key not in keys:
+                LRUCache.put(self, key, value)
+
+    def add_pin(self, key):
+        """
+            Pin one more key.
+        """
+        with self.lock:
+            self.pinned_keys = self.pinned_keys | frozenset([key])
+
+        value = LRUCache.pop(self, key)
+        if value is not None:
+            self.pinned[key] = value
+
+    def stats(self):
+        """
+            Get the usage counters of the cache, including the
+            hit rate per object type.
+        """
+        stats = LRUCache.stats(self)
+        stats["pinned"] = len(self.pinned)
+        stats["types"] = {}
+
+        for name, (hits, misses) in self.types.items():
+            stats["types"][name] = {
+                "hits": hits,
+                "misses": misses,
+                "hitrate": float(hits) / (hits+misses),
+            }
+
+        return stats
+
+def sizeof_object(obj):
+    """
+        Estimate the memory used by a decoded git object.
+    """
+    size = len(obj.as_raw_string())
+
+    # Trees and commits are also kept around parsed
+    if obj.type_name == "blob":
+        return 200 + size
+    return 500 + 3 * size
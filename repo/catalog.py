@@ -0,0 +1,268 @@
+import os
+import stat
+import pickle
+import bisect
+import threading
+import itertools
+import collections
+
+from repo.journal import ChangeJournal, ADDED, MODIFIED, DELETED
+
+CATALOG_VERSION = 1
+
+BranchPackages = collections.namedtuple("BranchPackages",
+                                        "head packages trees")
+
+class PackageCatalog(object):
+    def __init__(self, repo, path=None):
+        """
+            Materialized mapping of every branch head to the packages
+            it holds and the tree sha of each of those packages.
+            @param repo: The HurlGitRepo to catalog.
+            @param path: The file the catalog is persisted to. Defaults
+                to hurl-catalog in the repo's control directory.
+        """
+        self.repo = repo
+        self.path = path or os.path.join(repo.controldir(), "hurl-catalog")
+        self.lock = threading.Lock()
+
+        # Refs generation the catalog was last brought up to date with
+        self.generation = None
+
+        # branch -> BranchPackages
+        self.branches = {}
+
+        # Top-level tree sha -> whether it holds a Cakefile
+        self.trees = {}
+
+        # package -> {branch: tree sha}, and all package names sorted
+        self.packages = {}
+        self.names = []
+
+        # (names, their distinct first letters), filled in when needed
+        self._initials = None
+
+        # Package changes seen by this process
+        self.journal = ChangeJournal()
+
+        self.load()
+
+    def load(self):
+        """
+            Load the persisted catalog, if there is a usable one.
+        """
+        try:
+            with open(self.path, "rb") as fd:
+                data = pickle.load(fd)
+        except Exception:
+            return
+
+        if data.get("version") != CATALOG_VERSION:
+            return
+
+        self.branches = data["branches"]
+        self.trees = data["trees"]
+
+        changes = []
+        for branch, info in self.branches.items():
+            changes.extend(diff_branch(branch, None, info))
+        self.packages, self.names = reverse_index({}, self.branches, changes)
+
+    def save(self):
+        """
+            Atomically write the catalog to disk.
+        """
+        data = {
+            "version": CATALOG_VERSION,
+            "branches": self.branches,
+            "trees": self.trees,
+        }
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+
+        try:
+            with open(tmp, "wb") as fd:
+                pickle.dump(data, fd, 2)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # Not being able to persist only costs a rebuild on restart
+            pass
+
+    def update(self, snapshot):
+        """
+            Bring the catalog up to date with a refs snapshot and return
+            the branch mapping. Only branches whose head moved are walked
+            again, and only the package trees whose sha changed are read.
+        """
+        if self.generation is not None and \
+           snapshot.generation <= self.generation:
+            return self.branches
+
+        with self.lock:
+            if self.generation is not None and \
+               snapshot.generation <= self.generation:
+                return self.branches
+
+            branches, changes = {}, []
+            moved = set(self.branches) != set(snapshot.heads)
+
+            for branch, head in snapshot.heads.items():
+                old = self.branches.get(branch)
+
+                if old is not None and old.head == head:
+                    branches[branch] = old
+                else:
+                    branches[branch] = self.walk_branch(head)
+                    moved = True
+                    changes.extend(diff_branch(branch, old, branches[branch]))
+
+            for branch, old in self.branches.items():
+                if branch not in branches:
+                    changes.extend(diff_branch(branch, old, None))
+
+            # Nothing is known about changes from before this process
+            if self.generation is None:
+                self.journal.reset()
+            else:
+                self.journal.record(changes)
+
+            if changes:
+                self.packages, self.names = reverse_index(self.packages,
+                                                          branches, changes)
+
+            self.branches = branches
+            self.generation = snapshot.generation
+
+            if moved:
+                self.prune()
+                self.save()
+
+            return branches
+
+    def find(self, prefix=None, substring=None):
+        """
+            Get the sorted names of all packages starting with a prefix
+            and containing a substring.
+        """
+        return self.page(prefix, substring)[0]
+
+    def page(self, prefix=None, substring=None, after=None, limit=None):
+        """
+            Get the sorted names of packages starting with a prefix and
+            containing a substring, and whether there are more of them.
+            @param after: Only get names sorting after this one.
+            @param limit: The maximum amount of names to get.
+        """
+        names = self.names
+        start = bisect.bisect_left(names, prefix) if prefix else 0
+
+        if after:
+            start = max(start, bisect.bisect_right(names, after))
+
+        found = []
+        for name in itertools.islice(names, start, None):
+            if prefix and not name.startswith(prefix):
+                break
+            if substring and substring not in name:
+                continue
+
+            found.append(name)
+            if limit is not None and len(found) > limit:
+                return found[:limit], True
+
+        return found, False
+
+    def initials(self):
+        """
+            Get the sorted distinct first letters of all package names.
+        """
+        names = self.names
+        cached = self._initials
+
+        if cached is None or cached[0] is not names:
+            cached = (names, sorted(set(name[:1] for name in names)))
+            self._initials = cached
+
+        return cached[1]
+
+    def walk_branch(self, head):
+        """
+            Find all packages in the tree of a branch head.
+        """
+        commit = self.repo[head]
+        tree = self.repo[commit.tree]
+
+        packages, trees = [], {}
+
+        for mode, name, sha in tree.entries():
+            if not stat.S_ISDIR(mode):
+                continue
+
+            # Package trees are immutable, so only look into new ones
+            is_package = self.trees.get(sha)
+            if is_package is None:
+                is_package = any(entry[1] == "Cakefile"
+                                 for entry in self.repo[sha].entries())
+                self.trees[sha] = is_package
+
+            if is_package:
+                packages.append(name)
+                trees[name] = sha
+
+        return BranchPackages(head, packages, trees)
+
+    def prune(self):
+        """
+            Forget trees that are no longer referenced by any branch once
+            they start to outnumber the live ones.
+        """
+        live = set()
+        for info in self.branches.values():
+            live.update(info.trees.values())
+
+        if len(self.trees) > 4 * max(len(live), 1024):
+            self.trees = dict((sha, True) for sha in live)
+
+def diff_branch(branch, old, new):
+    """
+        Get the (branch, package, action) changes between two
+        BranchPackages of a branch, either of which may be None.
+    """
+    old = old.trees if old is not None else {}
+    new = new.trees if new is not None else {}
+    changes = []
+
+    for package, sha in new.items():
+        if package not in old:
+            changes.append((branch, package, ADDED))
+        elif old[package] != sha:
+            changes.append((branch, package, MODIFIED))
+
+    for package in old:
+        if package not in new:
+            changes.append((branch, package, DELETED))
+
+    return changes
+
+def reverse_index(packages, branches, changes):
+    """
+        Apply (branch, package, action) changes to a package to
+        {branch: tree sha} mapping, without modifying the original.
+        Returns the new mapping and its sorted package names.
+    """
+    packages = dict(packages)
+
+    for branch, package, action in changes:
+        trees = dict(packages.get(package, {}))
+
+        if action == DELETED:
+            trees.pop(branch, None)
+        else:
+            trees[branch] = branches[branch].trees[package]
+
+        if trees:
+            packages[package] = trees
+        else:
+            packages.pop(package, None)
+
+    return packages, sorted(packages)
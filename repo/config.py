@@ -0,0 +1,30 @@
+import os
+import ast
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "config")
+
+def load_config(path=None, section="hurl"):
+    """
+        Read a section of the config file used by the web application,
+        for use by the command line tools. Values are python literals,
+        like in the CherryPy config. Returns an empty dict if there's
+        no such file or section.
+        @param path: The config file, defaults to $HURL_CONFIG or the
+            config file next to hurlweb.py.
+    """
+    path = path or os.environ.get("HURL_CONFIG", DEFAULT_PATH)
+
+    parser = configparser.RawConfigParser()
+    parser.optionxform = str
+
+    if not parser.read(path) or not parser.has_section(section):
+        return {}
+
+    return dict((key, ast.literal_eval(value))
+                for key, value in parser.items(section))
@@ -2,309 +2,695 @@ import datetime
 import dulwich
 import yaml
 import re
+import os
+import time
+import stat
+import copy
+import hashlib
+import threading
+import itertools
+import collections
+
+from repo.catalog import PackageCatalog
+from repo.history import HistoryIndex
+from repo.cache import LRUCache, ObjectCache
+from repo.journal import DELETED
 
 try:
     from yaml import CLoader as Loader
 except ImportError:
     from yaml import Loader
 
-class HurlGitRepo(dulwich.repo.Repo):
-    def get_branches(self):
+MISSING = object()
+
+SHA_RE = re.compile("^[0-9a-f]{40}$")
+
+def sizeof_index(index):
+    """
+        Estimate the memory used by a tree index.
+    """
+    return 280 + sum(160 + len(name) for name in index)
+
+class RefSnapshot(object):
+    def __init__(self, refs, generation, previous=None):
         """
-            Get all branches in the entire repo.
+            An immutable view of all refs in the repo at one point in time.
+            @param refs: The ref name to sha mapping.
+            @param generation: Number identifying this snapshot, increases
+                every time the refs are reloaded.
+            @param previous: The snapshot this one replaces, if any.
         """
-        branches = []
+        self.refs = refs
+        self.generation = generation
+        self.heads = {}
 
-        for ref in self.get_refs():
+        for ref, sha in refs.items():
             if ref.startswith("refs/heads/"):
-                branches.append(ref[11:])
+                self.heads[ref[11:]] = sha
 
         # Move "master" and "staging" to the top
-        branches.sort(key=lambda br: not (br == "master" or 
-                                   br.startswith("staging")))
+        self.branches = sorted(self.heads)
+        self.branches.sort(key=lambda br: not (br == "master" or
+                                        br.startswith("staging")))
+
+        self.order = dict((br, num) for num, br in enumerate(self.branches))
+
+        # Identifies the state of all branches, for cache keys
+        self.digest = hashlib.sha1("".join("%s %s\n" % (branch, sha)
+            for branch, sha in sorted(self.heads.items()))).hexdigest()
+
+        # Branches can be created or deleted without any new commit, so
+        # views of all branches are dated by when the refs were read
+        self.loaded = time.time()
+
+        # branch -> time its current head was first seen. A branch reset
+        # to an older commit changes, but its commit time goes back.
+        self.seen = {}
+
+        for branch, sha in self.heads.items():
+            if previous is not None and previous.heads.get(branch) == sha:
+                self.seen[branch] = previous.seen[branch]
+            else:
+                self.seen[branch] = self.loaded
+
+class HurlGitRepo(dulwich.repo.Repo):
+    def __init__(self, root, cakefile_cache=4096, tree_cache=64*1024*1024,
+                 object_cache=128*1024*1024):
+        """
+            Open a hurl repository.
+            @param root: The path of the git repository.
+            @param cakefile_cache: The amount of parsed Cakefiles to
+                keep in memory. Defaults to 4096.
+            @param tree_cache: The approximate amount of bytes the tree
+                indexes kept in memory may use. Defaults to 64MiB.
+            @param object_cache: The approximate amount of bytes the
+                decoded objects kept in memory may use. Defaults to 128MiB.
+        """
+        self.object_cache = ObjectCache(object_cache)
+
+        dulwich.repo.Repo.__init__(self, root)
+
+        self._refs_lock = threading.Lock()
+        self._refs_snapshot = None
+        self._refs_signature = None
+        self._refs_generation = 0
+        self._local = threading.local()
+
+        self.catalog = PackageCatalog(self)
+        self.history = HistoryIndex(self)
+        self.cakefiles = LRUCache(cakefile_cache)
+        self.trees = LRUCache(tree_cache, sizeof=sizeof_index)
+
+    def cache_stats(self):
+        """
+            Get the usage counters of all caches on the repo.
+        """
+        return {
+            "cakefiles": self.cakefiles.stats(),
+            "trees": self.trees.stats(),
+            "objects": self.object_cache.stats(),
+        }
+
+    def __getitem__(self, name):
+        """
+            Get an object by sha, through the object cache.
+        """
+        # Refs aren't immutable, don't cache them
+        if not SHA_RE.match(name):
+            return dulwich.repo.Repo.__getitem__(self, name)
+
+        obj = self.object_cache.get(name)
+
+        if obj is None:
+            obj = dulwich.repo.Repo.__getitem__(self, name)
+            self.object_cache.put(name, obj)
+
+            # Keep the root trees of pinned branch heads pinned too
+            if name in self.object_cache.pinned_keys and \
+               obj.type_name == "commit":
+                self.object_cache.add_pin(obj.tree)
+
+        return obj
+
+    def _stat_refs(self):
+        """
+            Get a signature of the on-disk refs that changes whenever
+            a ref is added, updated or removed.
+        """
+        signature = []
+        packed = os.path.join(self.controldir(), "packed-refs")
+
+        try:
+            st = os.stat(packed)
+            signature.append((packed, st.st_mtime, st.st_size, st.st_ino))
+        except OSError:
+            pass
+
+        # Loose refs are always replaced by renaming a lockfile,
+        # so watching the directories is enough.
+        for path, dirs, files in os.walk(os.path.join(self.controldir(), "refs")):
+            signature.append((path, os.stat(path).st_mtime))
+
+        signature.sort()
+        return signature
 
-        return branches
+    def refs_snapshot(self):
+        """
+            Get the current snapshot of all refs in the repo, only
+            reloading them from disk if they changed.
+        """
+        pinned = getattr(self._local, "refs", None)
+        if pinned is not None:
+            return pinned
+
+        signature = self._stat_refs()
+
+        with self._refs_lock:
+            if self._refs_snapshot is None or \
+               signature != self._refs_signature:
+                self._refs_generation += 1
+                self._refs_snapshot = RefSnapshot(self.get_refs(),
+                    self._refs_generation, self._refs_snapshot)
+                self._refs_signature = signature
+                self._pin_heads(self._refs_snapshot)
+
+            return self._refs_snapshot
+
+    def _pin_heads(self, snapshot):
+        """
+            Pin the branch heads of a snapshot and their root trees
+            in the object cache.
+        """
+        keys = set(snapshot.heads.values())
+
+        for sha in snapshot.heads.values():
+            commit = self.object_cache.peek(sha)
+            if commit is not None:
+                keys.add(commit.tree)
+
+        self.object_cache.pin(keys)
+
+    def invalidate_refs(self):
+        """
+            Force the refs to be reloaded on the next snapshot.
+        """
+        with self._refs_lock:
+            self._refs_snapshot = None
+
+    def pin_refs(self):
+        """
+            Make the current thread use one refs snapshot until
+            unpin_refs is called, so a page renders from consistent refs.
+        """
+        self._local.refs = None
+        self._local.refs = self.refs_snapshot()
+
+    def unpin_refs(self):
+        """
+            Release the refs snapshot pinned to the current thread.
+        """
+        self._local.refs = None
+
+    def get_head(self, branch):
+        """
+            Get the sha of the commit a branch points at.
+        """
+        return self.refs_snapshot().heads.get(branch)
+
+    def get_head_mtime(self, branch):
+        """
+            Get the time a branch last changed, being the commit time of
+            its head or the time that head was first seen if later, so
+            it never goes back when the branch is reset.
+        """
+        sha = self.get_head(branch)
+        if sha is None:
+            return None
+        return max(self[sha].commit_time, self.get_head_seen(branch))
+
+    def get_head_seen(self, branch):
+        """
+            Get the time the commit a branch points at was first seen.
+        """
+        return self.refs_snapshot().seen.get(branch)
+
+    def get_refs_mtime(self):
+        """
+            Get the time the current state of the branches was first
+            seen, which moves forward whenever a branch is created,
+            moved or deleted.
+        """
+        return self.refs_snapshot().loaded
+
+    def get_branches(self):
+        """
+            Get all branches in the entire repo.
+        """
+        return list(self.refs_snapshot().branches)
 
     def count_branches(self):
         """
             Count the amount of branches in the repo.
         """
-        count = 0
-
-        for ref in self.get_refs():
-            if ref.startswith("refs/heads/"):
-                count += 1
+        return len(self.refs_snapshot().heads)
 
-        return count
+    def get_catalog(self):
+        """
+            Get the current refs snapshot and the branch to packages
+            mapping from the catalog that matches it.
+        """
+        snapshot = self.refs_snapshot()
+        return snapshot, self.catalog.update(snapshot)
 
-    def get_packages(self):
+    def get_packages(self, prefix=None, substring=None):
         """
             Get all packages in the entire repo and the branches
-            that they are in.
+            that they are in, sorted by package name.
+            @param prefix: Only get packages starting with this.
+            @param substring: Only get packages containing this.
         """
-        packages = {}
+        return self.get_packages_page(prefix, substring)[0]
 
-        for branch in self.get_branches():
-            for package in self.packages_in_branch(branch):
-                # First time we see this package, add it to the dict
-                if package not in packages:
-                    packages[package] = []
+    def get_packages_page(self, prefix=None, substring=None, after=None,
+                          limit=None):
+        """
+            Get a page of the packages in the entire repo and the
+            branches that they are in, sorted by package name, and
+            whether there are more packages after it.
+            @param prefix: Only get packages starting with this.
+            @param substring: Only get packages containing this.
+            @param after: Start after the package with this name.
+            @param limit: The maximum amount of packages to get.
+        """
+        snapshot = self.get_catalog()[0]
+        packages = collections.OrderedDict()
+        names, more = self.catalog.page(prefix, substring, after, limit)
 
-                # Add this branch as holding this package
-                packages[package].append(branch)
+        for package in names:
+            packages[package] = self.sort_branches(snapshot,
+                self.catalog.packages.get(package, {}))
 
-        return packages
+        return packages, more
 
+    def get_package_initials(self):
+        """
+            Get the sorted distinct first letters of all package names.
+        """
+        self.get_catalog()
+        return self.catalog.initials()
 
-    def branches_with_package(self, package):
+    def find_packages(self, prefix=None, substring=None):
         """
-            Get all branches that have a certain package in it.
+            Get the sorted names of all packages in the repo, optionally
+            only those starting with a prefix or containing a substring.
         """
-        branches = []
+        self.get_catalog()
+        return self.catalog.find(prefix, substring)
 
-        for branch in self.get_branches():
-            tree = self.get_package_tree(branch, package)
+    def package_names(self):
+        """
+            Get a read-only mapping with every package name in the repo
+            as a key, for quickly checking if the repo has a package.
+        """
+        self.get_catalog()
+        return self.catalog.packages
 
-            if tree is not None:
-                for entry in tree.entries():
-                    if entry[1] == "Cakefile":
-                        branches.append(branch)
-                        break
+    def count_packages(self):
+        """
+            Count the amount of distinct packages in the repo.
+        """
+        self.get_catalog()
+        return len(self.catalog.names)
 
-        return branches
+    def package_trees(self, package):
+        """
+            Get a {branch: tree sha} mapping of all branches that have
+            a certain package.
+        """
+        self.get_catalog()
+        return dict(self.catalog.packages.get(package, {}))
+
+    def sort_branches(self, snapshot, branches):
+        """
+            Sort branch names in the order of a refs snapshot.
+        """
+        return sorted((branch for branch in branches
+                       if branch in snapshot.order), key=snapshot.order.get)
+
+    def branches_with_package(self, package):
+        """
+            Get all branches that have a certain package in it.
+        """
+        snapshot = self.get_catalog()[0]
+
+        return self.sort_branches(snapshot,
+                                  self.catalog.packages.get(package, {}))
 
     def packages_in_branch(self, branch):
         """
             Get all packages in a certain branch.
         """
-        try:
-            sha = self.get_refs()["refs/heads/"+branch]
-        except KeyError:
+        snapshot, catalog = self.get_catalog()
+
+        if branch not in catalog:
+            return None
+
+        return list(catalog[branch].packages)
+
+    def tree_index(self, sha, tree=None):
+        """
+            Get a {name: (mode, sha)} mapping of the entries in a tree.
+            @param tree: The tree object, if the caller already has it.
+        """
+        index = self.trees.get(sha)
+
+        if index is None:
+            if tree is None:
+                tree = self[sha]
+
+            index = dict((name, (mode, ident))
+                         for mode, name, ident in tree.entries())
+
+            # Trees never change, so neither does their index
+            self.trees.put(sha, index)
+
+        return index
+
+    def lookup_path(self, branch, path):
+        """
+            Resolve a slash separated path in a branch to the
+            (mode, sha) of its entry, or None if it doesn't exist.
+        """
+        sha = self.get_head(branch)
+        if sha is None:
             return None
 
-        packages = []
-        commit = self[sha]
-        tree = self[commit.tree]
+        entry = (stat.S_IFDIR, self[sha].tree)
+
+        for name in path.split("/"):
+            if not name:
+                continue
+
+            if not stat.S_ISDIR(entry[0]):
+                return None
+
+            entry = self.tree_index(entry[1]).get(name)
+            if entry is None:
+                return None
 
-        for package in tree.entries():
-            subtree = self[package[2]]
+        return entry
 
-            if isinstance(subtree, dulwich.objects.Tree):
-                for entry in subtree.entries():
-                    if entry[1] == "Cakefile":
-                        packages.append(package[1])
-                        break
+    def package_index(self, branch=None, package=None, tree=None):
+        """
+            Get the tree index of a package, given either its branch
+            and name or its tree.
+        """
+        if branch is not None and package is not None:
+            entry = self.lookup_path(branch, package)
 
-        return packages
+            if entry is None or not stat.S_ISDIR(entry[0]):
+                return None
+            return self.tree_index(entry[1])
+
+        if tree is None:
+            return None
+        return self.tree_index(tree.id, tree)
 
     def get_branch_readme(self, branch):
         """
             Get the contents of a branch README if it exists.
         """
-        try:
-            sha = self.get_refs()["refs/heads/"+branch]
-        except KeyError:
+        sha = self.get_branch_readme_id(branch)
+        if sha is None:
             return None
 
-        commit = self[sha]
-        tree = self[commit.tree]
+        return self[sha].as_raw_string()
 
-        for entry in tree.entries():
-            if entry[1] == "README":
-                blob = self[entry[2]]
-                return blob.as_raw_string()
+    def get_branch_readme_id(self, branch):
+        """
+            Get the blob sha of a branch README if it exists.
+        """
+        entry = self.lookup_path(branch, "README")
+        if entry is None:
+            return None
 
-        return None
+        return entry[1]
 
     def get_package_tree(self, branch, package):
         """
             Get the tree of files under a certain package in a branch.
         """
-        try:
-            sha = self.get_refs()["refs/heads/"+branch]
-        except KeyError:
+        entry = self.lookup_path(branch, package)
+
+        if entry is None or not stat.S_ISDIR(entry[0]):
             return None
+        return self[entry[1]]
 
-        commit = self[sha]
-        tree = self[commit.tree]
+    def parse_cakefile(self, sha):
+        """
+            Get the parsed cakefile stored in a blob. The result is
+            shared with other callers and must not be modified.
+        """
+        cakefile = self.cakefiles.get(sha, MISSING)
 
-        for entry in tree.entries():
-            if entry[1] == package:
-                subtree = self[entry[2]]
+        if cakefile is MISSING:
+            blob = self[sha].as_raw_string()
+            cakefile = yaml.load(blob, Loader=Loader)
+            del blob
 
-                if isinstance(subtree, dulwich.objects.Tree):
-                    return subtree
-                else:
-                    return None
+            # Blobs never change, so neither does their parse
+            self.cakefiles.put(sha, cakefile)
 
-    def get_package_cakefile(self, branch=None, package=None, tree=None):
+        return cakefile
+
+    def get_package_cakefile(self, branch=None, package=None, tree=None,
+                             shared=False):
         """
             Get the parsed cakefile of a package in a branch.
+            @param shared: Return the cached cakefile itself instead of
+                a copy that the caller is free to modify.
         """
-        if branch is not None and package is not None:
-            tree = self.get_package_tree(branch, package)
-        if tree is None:
+        index = self.package_index(branch, package, tree)
+        if index is None or "Cakefile" not in index:
             return None
 
-        for entry in tree.entries():
-            if entry[1] == "Cakefile":
-                blob = self[entry[2]].as_raw_string()
-                cakefile = yaml.load(blob, Loader=Loader)
-                del blob
-                return cakefile
+        cakefile = self.parse_cakefile(index["Cakefile"][1])
+        return cakefile if shared else copy.deepcopy(cakefile)
 
     def get_package_readme(self, branch=None, package=None, tree=None):
         """
             Get the contents of a package's README if it exists.
         """
-        if branch is not None and package is not None:
-            tree = self.get_package_tree(branch, package)
-        if tree is None:
-            return None
+        return self.get_package_file("README", branch, package, tree)
 
-        for entry in tree.entries():
-            if entry[1] == "README":
-                blob = self[entry[2]]
-                return blob.as_raw_string()
-        return None
+    def get_package_readme_id(self, branch=None, package=None, tree=None):
+        """
+            Get the blob sha of a package's README if it exists.
+        """
+        return self.get_package_file_id("README", branch, package, tree)
 
     def get_package_file(self, filename, branch=None, package=None, tree=None):
         """
             Get the contents of a file in the package directory.
         """
-        if branch is not None and package is not None:
-            tree = self.get_package_tree(branch, package)
-        if tree is None:
+        sha = self.get_package_file_id(filename, branch, package, tree)
+        if sha is None:
             return None
 
-        for entry in tree.entries():
-            if entry[1] == filename:
-                return self[entry[2]].as_raw_string()
-        return None
+        return self[sha].as_raw_string()
+
+    def get_package_file_id(self, filename, branch=None, package=None,
+                            tree=None):
+        """
+            Get the blob sha of a file in the package directory.
+        """
+        index = self.package_index(branch, package, tree)
+        if index is None or filename not in index:
+            return None
+
+        return index[filename][1]
 
     def get_package_files(self, branch=None, package=None, tree=None):
         """
             Get a list of files in the package directory.
         """
-        if branch is not None and package is not None:
-            tree = self.get_package_tree(branch, package)
-        if tree is None:
+        index = self.package_index(branch, package, tree)
+        if index is None:
             return None
 
-        files = []
-        for entry in tree.entries():
-            files.append(entry[1])
-        return files
+        return sorted(index)
 
     def get_latest_versions(self, packages):
         """
             Get information about all packages from the list
             that were updated from their specified versions.
+
+            Packages are looked up grouped by branch, so each branch is
+            only resolved once and each distinct package tree is only
+            read and parsed once per call.
         """
-        # TODO: We really need to implement some sort of caching here,
-        # parsing all these cakefiles is ridiculous.
+        snapshot, catalog = self.get_catalog()
+
+        # Group by branch, remembering the order they were asked in
+        branches = {}
+        for num, (branch, package, version) in enumerate(packages):
+            if branch not in branches:
+                branches[branch] = []
+            branches[branch].append((num, package, version))
+
+        cakefiles = {}
         updated = []
-        for branch, package, version in packages:
-            cakefile = self.get_package_cakefile(branch, package)
 
-            # Check existence
-            if cakefile is None:
+        for branch, wanted in branches.items():
+            if branch not in catalog:
                 continue
 
-            # Check version
-            ver = str(cakefile["version"])+"-"+str(cakefile["release"])
-            if ver != str(version):
-                # List of dependencies
-                deps = [] if "dependencies" not in cakefile else \
-                       cakefile["dependencies"]
+            # Package name -> tree sha for the branch head
+            trees = catalog[branch].trees
+
+            for num, package, version in wanted:
+                # Check existence
+                if package not in trees:
+                    continue
 
-                # List of conflicting packages
-                conflicts = [] if "conflicts" not in cakefile else \
-                            cakefile["conflicts"]
+                sha = trees[package]
+                if sha not in cakefiles:
+                    entry = self.tree_index(sha).get("Cakefile")
+                    cakefiles[sha] = None if entry is None else \
+                                     self.parse_cakefile(entry[1])
 
-                updated.append({
-                    "package": package,
-                    "branch": branch,
-                    "version": ver,
-                    "dependencies": deps,
-                    "conflicts": conflicts})
-        return updated
+                cakefile = cakefiles[sha]
+                if cakefile is None:
+                    continue
 
-    def get_package_log(self, branch, package=None):
+                # Check version
+                ver = str(cakefile["version"])+"-"+str(cakefile["release"])
+                if ver != str(version):
+                    # List of dependencies
+                    deps = [] if "dependencies" not in cakefile else \
+                           cakefile["dependencies"]
+
+                    # List of conflicting packages
+                    conflicts = [] if "conflicts" not in cakefile else \
+                                cakefile["conflicts"]
+
+                    updated.append((num, {
+                        "package": package,
+                        "branch": branch,
+                        "version": ver,
+                        "dependencies": deps,
+                        "conflicts": conflicts}))
+
+        updated.sort(key=lambda upd: upd[0])
+        return [upd for num, upd in updated]
+
+    def get_generation(self):
         """
-            Get log entries for a branch or a package in
-            a branch.
+            Get the (epoch, generation) of the change journal that
+            matches the current refs.
         """
-        try:
-            sha = self.get_refs()["refs/heads/"+branch]
-        except KeyError:
-            return None
+        self.get_catalog()
+        journal = self.catalog.journal
+
+        return journal.epoch, journal.generation
 
-        log = []
+    def get_changes(self, epoch, generation):
+        """
+            Get all packages that changed after a journal generation.
+
+            Returns an (epoch, generation, updated, removed) tuple, updated
+            being in the format of get_latest_versions and removed being
+            a list of (branch, package) pairs. Updated and removed are None
+            if the journal can't tell and a full sync is needed.
+        """
+        self.get_catalog()
+        journal = self.catalog.journal
+        current, changes = journal.changes_since(epoch, generation)
 
-        for commit in self.revision_history(sha):
-            # Get data
-            lines = commit.as_raw_string().split("\n")
-            data = {}
+        if changes is None:
+            return journal.epoch, current, None, None
 
-            # Parse data
+        removed = sorted(key for key, action in changes.items()
+                         if action == DELETED)
+
+        # Without a version every package that exists counts as updated
+        updated = self.get_latest_versions(sorted(
+            (branch, package, None) for (branch, package), action
+            in changes.items() if action != DELETED))
+
+        return journal.epoch, current, updated, removed
+
+    def parse_commit(self, commit):
+        """
+            Parse a commit into a log entry.
+        """
+        # Get data
+        lines = commit.as_raw_string().split("\n")
+        data = {}
+
+        # Parse data
+        line = lines.pop(0)
+        while line:
+            key, value = line.split(" ", 1)
+            data[key] = value
             line = lines.pop(0)
-            while line:
-                key, value = line.split(" ", 1)
-                data[key] = value
-                line = lines.pop(0)
-
-            message = "\n".join(lines)
-
-            # Fall back to committer
-            if "committer" in data and "author" not in data:
-                data["author"] = data["committer"]
-
-            # Get commit
-            if "commit" not in data:
-                data["commit"] = commit.id
-
-            # Parse date
-            if "author" in data:
-                data["author"] = data["author"].split()
-                data["date"] = data["author"][-2:]
-                data["author"] = " ".join(data["author"][:-2])
-                data["date"][0] = datetime.datetime.fromtimestamp(int(data["date"][0]))
-
-            # Add log entry
-            if package is None:
-                log.append([data, message])
-            else:
-                tree = self[commit.tree]
-                parent_trees = [self[self[par].tree]
-                    for par in commit._get_parents()]
 
-                changed = False
+        message = "\n".join(lines)
+
+        # Fall back to committer
+        if "committer" in data and "author" not in data:
+            data["author"] = data["committer"]
+
+        # Get commit
+        if "commit" not in data:
+            data["commit"] = commit.id
 
-                for elem in tree.entries():
-                    if elem[1] == package:
-                        if not parent_trees:
-                            changed = True
-                            break
+        # Parse date
+        if "author" in data:
+            data["author"] = data["author"].split()
+            data["date"] = data["author"][-2:]
+            data["author"] = " ".join(data["author"][:-2])
+            data["date"][0] = datetime.datetime.fromtimestamp(int(data["date"][0]))
 
-                        found = False
-                        for parent in parent_trees:
-                            for parelem in parent.entries():
-                                if parelem[1] == package:
-                                    found = True
-                                    if parelem[2] != elem[2]:
-                                        changed = True
-                                    break
+        return [data, message]
 
-                        if not found:
-                            changed = True
+    def iter_package_log(self, branch, package=None, after=None):
+        """
+            Lazily get log entries for a branch or a package in
+            a branch, optionally starting after a certain commit.
+        """
+        sha = self.get_head(branch)
+        if sha is None:
+            return None
 
-                        break
+        return (self.parse_commit(self[commit]) for commit in
+                self.history.iter_commits(branch, sha, package, after))
 
-                if changed:
-                    log.append([data, message])
+    def get_package_mtime(self, branch, package):
+        """
+            Get the commit time of the last commit that changed
+            a package in a branch.
+        """
+        sha = self.get_head(branch)
+        if sha is None:
+            return None
+
+        for commit in self.history.iter_commits(branch, sha, package):
+            return self[commit].commit_time
+        return None
+
+    def get_package_log(self, branch, package=None, limit=None, after=None):
+        """
+            Get log entries for a branch or a package in
+            a branch.
+            @param limit: The maximum amount of entries to get.
+            @param after: Only get entries older than this commit.
+        """
+        log = self.iter_package_log(branch, package, after)
+        if log is None:
+            return None
 
-        return log
+        return list(itertools.islice(log, limit))
 
     def parse_dependency(self, dep):
         """
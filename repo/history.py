@@ -0,0 +1,231 @@
+import os
+import pickle
+import logging
+import threading
+import itertools
+
+HISTORY_VERSION = 1
+
+class HistoryIndex(object):
+    def __init__(self, repo, path=None):
+        """
+            Persisted index of which top-level entries every commit
+            changed, and of the commits on each branch in log order.
+            @param repo: The HurlGitRepo to index.
+            @param path: The file the index is persisted to. Defaults
+                to hurl-history in the repo's control directory.
+        """
+        self.repo = repo
+        self.path = path or os.path.join(repo.controldir(), "hurl-history")
+        self.lock = threading.Lock()
+
+        # branch -> Lock, held while indexing new commits of the branch
+        self.branch_locks = {}
+
+        # commit sha -> frozenset of changed top-level names
+        self.changed = {}
+
+        # branch -> (head, [commit shas, newest first], {sha: position})
+        self.branches = {}
+
+        self.load()
+
+        # Saved in the background, requests shouldn't wait on the disk
+        self.dirty = threading.Event()
+        thread = threading.Thread(target=self.run_save)
+        thread.daemon = True
+        thread.start()
+
+    def load(self):
+        """
+            Load the persisted index, if there is a usable one.
+        """
+        try:
+            with open(self.path, "rb") as fd:
+                data = pickle.load(fd)
+        except Exception:
+            return
+
+        if data.get("version") != HISTORY_VERSION:
+            return
+
+        self.changed = data["changed"]
+        for branch, (head, commits) in data["branches"].items():
+            self.branches[branch] = (head, commits, positions(commits))
+
+    def save(self):
+        """
+            Atomically write the index to disk.
+        """
+        # Copied so pickling doesn't block updates, the values are
+        # never changed in place
+        with self.lock:
+            data = {
+                "version": HISTORY_VERSION,
+                "changed": dict(self.changed),
+                "branches": dict((branch, (head, commits)) for branch,
+                    (head, commits, pos) in self.branches.items()),
+            }
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+
+        try:
+            with open(tmp, "wb") as fd:
+                pickle.dump(data, fd, 2)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # Not being able to persist only costs a rebuild on restart
+            pass
+
+    def run_save(self):
+        """
+            Keep saving the index whenever it changed.
+        """
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+
+            try:
+                self.save()
+            except Exception:
+                logging.exception("History save error.")
+
+    def branch_lock(self, branch):
+        """
+            Get the lock held while indexing new commits of a branch.
+        """
+        with self.lock:
+            return self.branch_locks.setdefault(branch, threading.Lock())
+
+    def commits(self, branch, head):
+        """
+            Get the (commits, positions) of a branch at a head, indexing
+            the commits that were added since it was last seen.
+        """
+        entry = self.branches.get(branch)
+        if entry is not None and entry[0] == head:
+            return entry[1], entry[2]
+
+        # Other branches can be indexed meanwhile
+        with self.branch_lock(branch):
+            entry = self.branches.get(branch)
+            if entry is not None and entry[0] == head:
+                return entry[1], entry[2]
+
+            commits = None
+            if entry is not None:
+                commits = self.fast_forward(entry[0], entry[1], head)
+
+            # New branch or rewritten history
+            if commits is None:
+                commits = [commit.id for commit in
+                           self.repo.revision_history(head)]
+
+            new = dict((sha, self.changed_entries(sha)) for sha in commits
+                       if sha not in self.changed)
+            pos = positions(commits)
+            heads = self.repo.refs_snapshot().heads
+
+            with self.lock:
+                self.changed.update(new)
+                self.branches[branch] = (head, commits, pos)
+
+                # Forget deleted branches and the commits only they had
+                deleted = [name for name in self.branches
+                           if name not in heads and name != branch]
+
+                if deleted:
+                    for name in deleted:
+                        del self.branches[name]
+                        self.branch_locks.pop(name, None)
+
+                    live = set()
+                    for entry in self.branches.values():
+                        live.update(entry[1])
+                    self.changed = dict((sha, self.changed[sha])
+                                        for sha in live)
+
+            self.dirty.set()
+            return commits, pos
+
+    def fast_forward(self, old_head, old_commits, head):
+        """
+            Get the commits of a branch that moved from old_head to head,
+            or None if head doesn't descend from old_head.
+        """
+        known = set(old_commits)
+        new, seen, todo = [], set(), [head]
+        reached_old = False
+
+        while todo:
+            sha = todo.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+
+            if sha in known:
+                reached_old = reached_old or sha == old_head
+                continue
+
+            commit = self.repo[sha]
+            new.append(commit)
+            todo.extend(commit.parents)
+
+        if not reached_old:
+            return None
+
+        new.sort(key=lambda commit: commit.commit_time, reverse=True)
+        return [commit.id for commit in new] + old_commits
+
+    def changed_entries(self, sha):
+        """
+            Get the top-level entries a commit changed compared to
+            its parents.
+        """
+        commit = self.repo[sha]
+        tree = tree_map(self.repo[commit.tree])
+        parents = [tree_map(self.repo[self.repo[par].tree])
+                   for par in commit.parents]
+
+        if not parents:
+            return frozenset(tree)
+
+        changed = set()
+        for name, entry in tree.items():
+            found = [parent[name] for parent in parents if name in parent]
+
+            if not found or any(other != entry for other in found):
+                changed.add(name)
+
+        return frozenset(changed)
+
+    def iter_commits(self, branch, head, package=None, after=None):
+        """
+            Iterate over the commits of a branch in log order, optionally
+            only those changing a package and starting after a commit.
+        """
+        commits, pos = self.commits(branch, head)
+        changed = self.changed
+
+        if after is None:
+            start = 0
+        elif after in pos:
+            start = pos[after]+1
+        else:
+            return
+
+        for sha in itertools.islice(commits, start, None):
+            if package is None or package in changed[sha]:
+                yield sha
+
+def tree_map(tree):
+    """
+        Map the names in a tree to their sha.
+    """
+    return dict((name, sha) for mode, name, sha in tree.entries())
+
+def positions(commits):
+    """
+        Map commit shas to their position in a list.
+    """
+    return dict((sha, num) for num, sha in enumerate(commits))
@@ -0,0 +1,81 @@
+import os
+import binascii
+import threading
+
+ADDED, MODIFIED, DELETED = "A", "M", "D"
+
+class ChangeJournal(object):
+    def __init__(self, maxentries=65536):
+        """
+            In-memory journal of package changes, numbered by an always
+            increasing generation.
+            @param maxentries: The amount of changes to remember before
+                the oldest ones are compacted away. Defaults to 65536.
+        """
+        self.maxentries = maxentries
+        self.lock = threading.Lock()
+
+        # Generations are only comparable within one epoch
+        self.epoch = binascii.hexlify(os.urandom(8)).decode("ascii")
+        self.generation = 0
+
+        # Changes up to and including this generation were dropped
+        self.floor = 0
+
+        # List of (generation, branch, package, action), oldest first
+        self.entries = []
+
+    def reset(self):
+        """
+            Start a new generation without knowing what changed before it.
+        """
+        with self.lock:
+            self.generation += 1
+            self.floor = self.generation
+            self.entries = []
+
+    def record(self, changes):
+        """
+            Record a list of (branch, package, action) changes as
+            a new generation.
+        """
+        if not changes:
+            return
+
+        with self.lock:
+            self.generation += 1
+            entries = self.entries + [(self.generation, branch, package, action)
+                                      for branch, package, action in changes]
+
+            # Compact
+            if len(entries) > self.maxentries:
+                drop = len(entries)-self.maxentries
+                self.floor = entries[drop-1][0]
+                entries = entries[drop:]
+
+            self.entries = entries
+
+    def changes_since(self, epoch, generation):
+        """
+            Get the (generation, changes) made after a generation, changes
+            mapping (branch, package) to the last action done on it.
+
+            Changes is None if the journal can't tell, because the
+            generation is from another epoch or was compacted away.
+        """
+        with self.lock:
+            current, floor, entries = self.generation, self.floor, self.entries
+
+        if epoch != self.epoch or not floor <= generation <= current:
+            return current, None
+
+        changes = {}
+        for gen, branch, package, action in reversed(entries):
+            if gen <= generation:
+                break
+
+            # Newest action wins
+            if (branch, package) not in changes:
+                changes[branch, package] = action
+
+        return current, changes
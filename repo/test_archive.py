@@ -0,0 +1,121 @@
+import io
+import gzip
+import struct
+import tarfile
+import unittest
+
+try:
+    from dulwich.objects import Blob, Tree
+    from repo.archive import BLOCK_SIZE, stream_tree
+except ImportError:
+    Blob = Tree = None
+
+MTIME = 1234567890
+
+class MemoryRepo(object):
+    """
+        Just enough of a repo to stream archives from.
+    """
+    def __init__(self):
+        self.object_store = {}
+
+def big_file():
+    """
+        Get file data spanning several parallel compression blocks.
+    """
+    return "".join("%08d\n" % i for i in range(3*BLOCK_SIZE//9))
+
+def synthetic_tree():
+    """
+        Build a package tree with a plain file, an executable, a
+        symlink and a subdirectory holding a file large enough to be
+        split over several compression blocks.
+        @return: (repo, tree)
+    """
+    repo = MemoryRepo()
+    store = repo.object_store
+
+    def blob(data):
+        obj = Blob.from_string(data)
+        store[obj.id] = obj
+        return obj.id
+
+    files = Tree()
+    files["big"] = (0o100644, blob(big_file()))
+    files["patch"] = (0o100664, blob("--- a\n+++ b\n"))
+    store[files.id] = files
+
+    tree = Tree()
+    tree["Cakefile"] = (0o100644, blob("name: test\n"))
+    tree["build.sh"] = (0o100755, blob("#!/bin/sh\nmake\n"))
+    tree["files"] = (0o040000, files.id)
+    tree["link"] = (0o120000, blob("build.sh"))
+    store[tree.id] = tree
+
+    return repo, tree
+
+def build(repo, tree, workers):
+    return "".join(stream_tree(repo, tree, "master-test", "tar.gz", MTIME,
+                               workers=workers))
+
+@unittest.skipIf(Blob is None, "dulwich isn't installed")
+class ReproducibleArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.repo, self.tree = synthetic_tree()
+
+    def check_archive(self, workers):
+        data = build(self.repo, self.tree, workers)
+
+        # The same tree always gives the same bytes
+        self.assertEqual(data, build(self.repo, self.tree, workers))
+
+        # Fixed timestamp and no file name in the gzip header
+        self.assertEqual(data[:10], "\037\213\010\000" +
+                         struct.pack("<L", MTIME) + "\000\377")
+
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as fd:
+            tar = fd.read()
+
+        archive = tarfile.open(fileobj=io.BytesIO(tar))
+        members = archive.getmembers()
+
+        self.assertEqual([info.name for info in members], [
+            "master-test/Cakefile",
+            "master-test/build.sh",
+            "master-test/files/big",
+            "master-test/files/patch",
+            "master-test/link",
+        ])
+
+        for info in members:
+            self.assertEqual((info.uid, info.gid), (0, 0))
+            self.assertEqual((info.uname, info.gname), ("", ""))
+            self.assertEqual(info.mtime, MTIME)
+
+        modes = dict((info.name, info.mode) for info in members)
+        self.assertEqual(modes["master-test/Cakefile"], 0o644)
+        self.assertEqual(modes["master-test/build.sh"], 0o755)
+        self.assertEqual(modes["master-test/files/patch"], 0o644)
+
+        link = archive.getmember("master-test/link")
+        self.assertTrue(link.issym())
+        self.assertEqual(link.linkname, "build.sh")
+
+        big = archive.extractfile("master-test/files/big").read()
+        self.assertEqual(big, big_file())
+
+        return data, tar
+
+    def test_single_worker(self):
+        self.check_archive(1)
+
+    def test_parallel_workers(self):
+        data, tar = self.check_archive(4)
+
+        # Split into several gzip members holding the same tar
+        self.assertTrue(data.count("\037\213\010\000" +
+                                   struct.pack("<L", MTIME)) > 1)
+        self.assertEqual(tar, self.check_archive(1)[1])
+
+if __name__ == '__main__':
+    unittest.main()
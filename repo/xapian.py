@@ -1,9 +1,17 @@
 import os
+import re
 import sys
-import datetime
+import pickle
+import shutil
+import logging
+import threading
+import collections
+import multiprocessing
 import xappy
 import time
 
+from repo.cache import LRUCache
+
 STORE_CONTENT = ([xappy.FieldActions.STORE_CONTENT], {})
 INDEX_FREETEXT = ([xappy.FieldActions.INDEX_FREETEXT], {})
 INDEX_NONDEFAULT = ([xappy.FieldActions.INDEX_FREETEXT], {"search_by_default": False})
@@ -19,38 +27,166 @@ FIELDS = {
     "build-dependencies": [INDEX_NONDEFAULT],
 }
 
+STATE_VERSION = 1
+
 class HurlXapianIndex(object):
-    def __init__(self, dbpath, refresh_after=30):
+    def __init__(self, dbpath, refresh_after=30, cache_size=1024,
+                 check_interval=1.0):
         """
             Initialise a new hurl index object.
             @param dbpath: The database path used for the index.
             @param refresh_after: The amount of minutes after an index
-                is considered stale and should be refreshed. Defaults
-                to 30.
+                is refreshed even if it wasn't updated. Defaults to 30.
+            @param cache_size: The amount of search results pages to
+                keep until the index is refreshed.
+            @param check_interval: The minimum amount of seconds between
+                checks for updates to the index.
         """
         self.dbpath = dbpath
         self.refresh_after = refresh_after
-        self.db, self.conn = None, None
+        self.check_interval = check_interval
+        self.db = None
+
+        # Search connections aren't thread-safe, every thread gets its own
+        self._local = threading.local()
+
+        # Touched after every flush to tell readers to reopen
+        self.marker = dbpath+".generation"
+
+        # (generation, query, offset, limit) -> search results
+        self.results = LRUCache(cache_size)
+
+        # Build the write connection was opened on, dbpath may be a
+        # symlink that reindex points at a new build
+        self.target = None
+
+        # "branch/package" -> indexed tree sha, loaded with the write
+        # connection and saved with every flush
+        self.state_path = None
+        self.trees = None
+
+        # Whether the trees were loaded from a state file
+        self.has_state = False
 
     def _connect_read(self):
         """
-            Make sure a read connection has been made.
+            Make sure the current thread has an up to date read
+            connection, and return it.
+        """
+        local = self._local
+        now = time.time()
+
+        if getattr(local, "conn", None) is None:
+            local.generation = self.generation()
+            local.conn = xappy.SearchConnection(self.dbpath)
+            local.opened = local.checked = now
+        elif now - local.checked >= self.check_interval:
+            local.checked = now
+            generation = self.generation()
+
+            # Check for updated or stale index
+            if generation != local.generation:
+                self.reload()
+                return self._connect_read()
+
+            if now - local.opened > self.refresh_after * 60:
+                # Writers that don't publish can't be told apart by
+                # generation, so drop the results of them all
+                self.results.clear()
+                self.reload()
+                return self._connect_read()
+
+        return local.conn
+
+    def generation(self):
         """
-        if self.conn is None:
-            self.conn = xappy.SearchConnection(self.dbpath)
-            self.updated = datetime.datetime.now()
-        # Check for stale index
-        elif datetime.datetime.now()-self.updated > \
-            datetime.timedelta(minutes=self.refresh_after):
-            self.reload()
-            self.updated = datetime.datetime.now()
+            Get a value that changes every time the index is flushed.
+        """
+        try:
+            st = os.stat(self.marker)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def publish(self):
+        """
+            Tell readers the index changed.
+        """
+        if self.marker is None:
+            return
+
+        tmp = "%s.%d.tmp" % (self.marker, os.getpid())
+
+        try:
+            with open(tmp, "w") as fd:
+                fd.write("%f\n" % time.time())
+            os.rename(tmp, self.marker)
+        except (IOError, OSError):
+            logging.exception("Could not publish index generation.")
 
     def _connect_write(self):
         """
             Make sure a write connection has been made.
         """
         if self.db is None:
-            self.db = xappy.IndexerConnection(self.dbpath)
+            self.target = os.path.realpath(self.dbpath)
+            self.state_path = os.path.join(self.target, "hurl-state")
+            self.trees = None
+            self.db = xappy.IndexerConnection(self.target)
+
+        if self.trees is None:
+            self.load_state()
+
+    def check_swap(self):
+        """
+            Move the write connection over to a new build if the database
+            path was pointed at one since it was opened. Returns whether
+            it was, in which case changes made since the build started
+            are missing from it.
+        """
+        if self.db is None or os.path.realpath(self.dbpath) == self.target:
+            return False
+
+        self.close()
+        self._connect_write()
+        return True
+
+    def load_state(self):
+        """
+            Load the tree shas the packages were indexed at.
+        """
+        self.trees = {}
+        self.has_state = False
+
+        try:
+            with open(self.state_path, "rb") as fd:
+                data = pickle.load(fd)
+        except Exception:
+            return
+
+        if data.get("version") == STATE_VERSION:
+            self.trees = data["trees"]
+            self.has_state = True
+
+    def save_state(self):
+        """
+            Atomically write the tree shas the packages were indexed at.
+            Only done once they're known for every package, a partial
+            map would hide packages indexed before it from update.
+        """
+        if self.trees is None or not self.has_state:
+            return
+
+        data = {"version": STATE_VERSION, "trees": self.trees}
+        tmp = "%s.%d.tmp" % (self.state_path, os.getpid())
+
+        try:
+            with open(tmp, "wb") as fd:
+                pickle.dump(data, fd, 2)
+            os.rename(tmp, self.state_path)
+        except (IOError, OSError):
+            # Not being able to persist only costs reindexing on update
+            pass
 
     def flush(self):
         """
@@ -59,16 +195,32 @@ class HurlXapianIndex(object):
         if self.db is None:
             return
         self.db.flush()
+        self.save_state()
+        self.publish()
+
+    def close(self):
+        """
+            Flush and close the write connection.
+        """
+        if self.db is None:
+            return
+        self.flush()
+        self.db.close()
+        self.db = None
 
     def reload(self):
         """
             Reload the index from the source.
         """
-        if self.conn is None:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
             return
-        self.conn.reopen()
 
-    def search(self, terms):
+        # Open anew rather than reopen, the path may point at a new build
+        self._local.conn = None
+        conn.close()
+
+    def search(self, terms, offset=0, limit=10):
         """
             Search the index for a set of terms.
 
@@ -77,40 +229,53 @@ class HurlXapianIndex(object):
             the amount of results was exact or approximated.
             Results is a list of dictionaries containing at least
             the keys "package", "branch", "tags" and "description".
+            @param offset: The amount of results to skip.
+            @param limit: The maximum amount of results to get.
         """
         # Make sure we can read
-        self._connect_read()
+        conn = self._connect_read()
+
+        terms = " ".join(terms.split())
+        key = (self._local.generation, terms, offset, limit)
+        found = self.results.get(key)
 
-        # Run query
-        q = self.conn.query_parse(terms, default_op=self.conn.OP_AND)
-        results = self.conn.search(q, 0, 10, sortby="-priority", collapse="package")
+        if found is None:
+            found = self.run_search(conn, terms, offset, limit)
+            self.results.put(key, found)
+
+        return found
+
+    def run_search(self, conn, terms, offset, limit):
+        """
+            Run a query against the index.
+        """
+        q = conn.query_parse(terms, default_op=conn.OP_AND)
+        results = conn.search(q, offset, offset+limit,
+                                   sortby="-priority", collapse="package")
 
         # Sanitise results
-        def iter_docs():
-            for doc in results:
-                data = doc.data
-                print(repr(data))
+        docs = []
+        for doc in results:
+            data = doc.data
 
-                # Use only the first data entry
-                for item in data:
-                    data[item] = data[item][0]
+            # Use only the first data entry
+            for item in data:
+                data[item] = data[item][0]
 
-                # Split up tags
-                if "tags" in data:
-                    data["tags"] = data["tags"].split()
+            # Split up tags
+            if "tags" in data:
+                data["tags"] = data["tags"].split()
 
-                yield data
+            docs.append(data)
 
-        return iter_docs(), results.matches_estimated, results.estimate_is_exact
+        return docs, results.matches_estimated, results.estimate_is_exact
 
     def count(self):
         """
             Count the amount of packages in the index.
         """
         # Make sure we can read
-        self._connect_read()
-
-        return self.conn.get_doccount()
+        return self._connect_read().get_doccount()
 
     def create(self):
         """
@@ -165,31 +330,26 @@ class HurlXapianIndex(object):
         """
             (Re)Index a single package.
         """
-        self._connect_write()
-
-        # Get data
-        cakefile = repo.get_package_cakefile(branch, package)
+        fields = package_fields(repo, branch, package)
 
-        if cakefile is None:
+        if fields is None:
             return
 
-        # Fill document
-        doc = xappy.UnprocessedDocument()
-        doc.fields.append(xappy.Field("package", package))
-        doc.fields.append(xappy.Field("branch", branch))
-        doc.fields.append(xappy.Field("user", branch.split("/")[0]))
-        doc.fields.append(xappy.Field("priority", str(int(branch == "master"))))
-        doc.id = branch+"/"+package
+        self.replace_document(branch+"/"+package, fields)
+        self.trees[branch+"/"+package] = \
+            repo.package_trees(package).get(branch)
 
-        # Add fields
-        for field in FIELDS:
-            if field in cakefile:
-                data = cakefile[field]
-
-                if hasattr(data, "__iter__"):
-                    data = " ".join(data)
+    def replace_document(self, ident, fields):
+        """
+            Add or replace a document made of (name, value) fields.
+        """
+        self._connect_write()
 
-                doc.fields.append(xappy.Field(field.replace("-", ""), str(data)))
+        # Fill document
+        doc = xappy.UnprocessedDocument()
+        for name, value in fields:
+            doc.fields.append(xappy.Field(name, value))
+        doc.id = ident
 
         # Add document to index
         self.db.replace(doc)
@@ -200,64 +360,396 @@ class HurlXapianIndex(object):
         """
         self._connect_write()
         self.db.delete(branch+"/"+package)
+        self.trees.pop(branch+"/"+package, None)
+
+    def indexed_packages(self):
+        """
+            Get the ids of all packages in the index, asking the index
+            itself if their trees aren't all known.
+        """
+        self._connect_write()
+
+        if self.has_state:
+            return list(self.trees)
+
+        # Also packages indexed since the last flush
+        return list(set(self.trees) | set(self._connect_read().iterids()))
+
+    def update(self, repo):
+        """
+            Bring the index up to date with the repo, reindexing the
+            packages whose tree changed since they were indexed and
+            deleting the ones that are gone.
+            Returns the amount of packages reindexed and deleted.
+        """
+        self._connect_write()
+
+        current = package_trees(repo)
+        changed = [ident for ident, sha in current.items()
+                   if self.trees.get(ident) != sha]
+
+        removed = [ident for ident in self.indexed_packages()
+                   if ident not in current]
+
+        for ident in changed:
+            branch, package = ident.rsplit("/", 1)
+            print("M "+ident)
+            self.index_package(repo, branch, package)
+
+        for ident in removed:
+            branch, package = ident.rsplit("/", 1)
+            print("D "+ident)
+            self.delete_package(branch, package)
 
-def listen(index, repo, queue_key=1313):
+        self.trees = current
+        self.has_state = True
+        self.flush()
+
+        return len(changed), len(removed)
+
+def package_fields(repo, branch, package):
+    """
+        Get the (name, value) fields of the document for a package, or
+        None if it has no Cakefile.
+    """
+    cakefile = repo.get_package_cakefile(branch, package, shared=True)
+
+    if cakefile is None:
+        return None
+
+    fields = [
+        ("package", package),
+        ("branch", branch),
+        ("user", branch.split("/")[0]),
+        ("priority", str(int(branch == "master"))),
+    ]
+
+    for field in FIELDS:
+        if field in cakefile:
+            data = cakefile[field]
+
+            if hasattr(data, "__iter__"):
+                data = " ".join(data)
+
+            fields.append((field.replace("-", ""), str(data)))
+
+    return fields
+
+def package_trees(repo):
+    """
+        Get the tree sha of every package in a repo, keyed on
+        "branch/package".
+    """
+    trees = {}
+
+    for branch, entry in repo.get_catalog()[1].items():
+        for package, sha in entry.trees.items():
+            trees[branch+"/"+package] = sha
+
+    return trees
+
+# Repo opened by each reindex worker process
+_worker_repo = None
+
+def init_worker(path):
+    global _worker_repo
+
+    from repo.git import HurlGitRepo
+    _worker_repo = HurlGitRepo(path)
+
+def branch_documents(branch):
+    """
+        Get the (id, fields) documents of all packages in a branch, in
+        a reindex worker process.
+    """
+    docs = []
+
+    for package in _worker_repo.packages_in_branch(branch) or []:
+        fields = package_fields(_worker_repo, branch, package)
+
+        if fields is not None:
+            docs.append((branch+"/"+package, fields))
+
+    return docs
+
+def bulk_index(index, repo, workers=None, flush_every=1000):
+    """
+        Index all packages in a repo, with a pool of processes reading
+        the packages of every branch and this process writing them.
+        @param repo: The HurlGitRepo to index.
+        @param workers: Amount of processes, defaults to one per CPU.
+        @param flush_every: Flush after this many documents.
+    """
+    pool = multiprocessing.Pool(workers, init_worker, (repo.path,))
+    start, count = time.time(), 0
+
+    try:
+        for docs in pool.imap_unordered(branch_documents,
+                                        repo.get_branches()):
+            for ident, fields in docs:
+                index.replace_document(ident, fields)
+                count += 1
+
+                if count % flush_every == 0:
+                    index.flush()
+                    print("%d documents, %.1f docs/sec" % (count,
+                        count / (time.time()-start)))
+    finally:
+        pool.close()
+        pool.join()
+
+    index.flush()
+    taken = time.time()-start
+    print("Indexed %d documents in %.3fs, %.1f docs/sec" % (count, taken,
+        count / taken if taken else 0))
+
+def rebuild(repo, dbpath, workers=None, flush_every=1000):
+    """
+        Build a new index of a repo next to the database and swap it
+        in once it's complete, so the old one can be searched until
+        then. The database path becomes a symlink to the current build.
+    """
+    build = "%s.%d" % (dbpath, int(time.time()))
+
+    index = HurlXapianIndex(build)
+    index.marker = None
+    index.create()
+
+    # Packages changing while building get picked up by the listener or
+    # the next update
+    index.trees = package_trees(repo)
+    index.has_state = True
+
+    bulk_index(index, repo, workers, flush_every)
+    index.close()
+
+    swap_database(dbpath, build)
+    HurlXapianIndex(dbpath).publish()
+
+def swap_database(dbpath, build):
+    """
+        Atomically point the database path at a new build, removing
+        all builds but the new and the previous one.
+    """
+    directory, name = os.path.split(os.path.abspath(dbpath))
+    previous = None
+
+    if os.path.islink(dbpath):
+        previous = os.readlink(dbpath)
+    elif os.path.exists(dbpath):
+        # Turn a plain database into the previous build
+        previous = "%s.0" % name
+        os.rename(dbpath, os.path.join(directory, previous))
+
+    link = "%s.%d.tmp" % (dbpath, os.getpid())
+    os.symlink(os.path.basename(build), link)
+    os.rename(link, dbpath)
+
+    # Clean up older builds
+    builds = re.compile("^%s\\.[0-9]+$" % re.escape(name))
+    keep = (os.path.basename(build), previous)
+
+    for entry in os.listdir(directory):
+        if builds.match(entry) and entry not in keep:
+            shutil.rmtree(os.path.join(directory, entry), True)
+
+# Message types sent to the listener
+CHANGED, DELETED, BRANCH_DELETED = 1, 2, 3
+
+def receive_batch(queue, window=2.0, batch_size=1000):
     """
-        Listen on a message queue for new packages to index.
+        Wait for a message on the queue, then keep draining it for a
+        while to collect changes that can be applied together.
+        Returns an ordered {(branch, package): type} mapping with only
+        the last change to every package, package being None for
+        deleted branches, the amount of messages received and the time
+        the first one was received at.
+        @param window: Seconds to keep collecting after the first message.
+        @param batch_size: Stop collecting at this many changes.
+    """
+    from sysv_ipc import BusyError
+
+    changes = collections.OrderedDict()
+    messages, message = 0, queue.receive()
+    received = time.time()
+    deadline = received + window
+
+    while True:
+        line, typ = message
+        line = line.strip()
+        messages += 1
+
+        if typ == BRANCH_DELETED and line:
+            # Earlier changes to the branch don't matter anymore
+            for key in [key for key in changes if key[0] == line]:
+                del changes[key]
+            changes[(line, None)] = typ
+        elif "/" in line:
+            key = tuple(map(str.strip, line.rsplit("/", 1)))
+            changes.pop(key, None)
+            changes[key] = typ
+        elif line:
+            print("Error: `%s` is not a valid package." % line)
+
+        if len(changes) >= batch_size:
+            break
+
+        # Wait for more messages until the window is over
+        message = None
+        while message is None and time.time() < deadline:
+            try:
+                message = queue.receive(block=False)
+            except BusyError:
+                time.sleep(0.05)
+
+        if message is None:
+            break
+
+    return changes, messages, received
+
+def catch_up(index, repo):
+    """
+        Bring the index up to date with the repo if it was rebuilt
+        since the write connection was opened.
+    """
+    if index.check_swap():
+        print("Index was rebuilt, updating it")
+        index.update(repo)
+
+def apply_batch(index, repo, changes, prewarm=None):
+    """
+        Apply a batch of changes to the index and commit them at once.
+    """
+    catch_up(index, repo)
+
+    for (branch, package), typ in changes.items():
+        try:
+            if typ == BRANCH_DELETED:
+                # The repo no longer knows the branch, the index does
+                prefix = branch+"/"
+
+                for ident in [ident for ident in index.indexed_packages()
+                              if ident.startswith(prefix)]:
+                    print("D "+ident)
+                    index.delete_package(branch, ident[len(prefix):])
+            elif typ == CHANGED:
+                print("M "+branch+"/"+package)
+                index.index_package(repo, branch, package)
+            elif typ == DELETED:
+                print("D "+branch+"/"+package)
+                index.delete_package(branch, package)
+        except Exception:
+            logging.exception("Indexing error.")
+
+    index.flush()
+
+    # The batch may have gone into a build that was just replaced
+    catch_up(index, repo)
+
+    if prewarm is not None:
+        for (branch, package), typ in changes.items():
+            if typ == BRANCH_DELETED:
+                prewarm.discard(branch)
+            elif typ == CHANGED:
+                prewarm.schedule(branch, package)
+            elif typ == DELETED:
+                prewarm.discard(branch, package)
+
+def listen(index, repo, queue_key=1313, prewarm=None, window=2.0,
+           batch_size=1000):
+    """
+        Listen on a message queue for new packages to index, applying
+        the changes in batches.
+        @param prewarm: ArchivePrewarmer to build the archives of changed
+            packages with, if any.
+        @param window: Seconds to collect changes for after the first
+            one before applying them, which also gives pushes time to
+            finish.
+        @param batch_size: Apply changes once this many were collected.
     """
     # Create the queue
     from sysv_ipc import MessageQueue, IPC_CREAT
     queue = MessageQueue(queue_key, IPC_CREAT)
 
+    stats = {"messages": 0, "changes": 0, "batches": 0,
+             "max_batch": 0, "max_lag": 0.0}
+
     while True:
-        line, typ = queue.receive()
-
-        if line.strip():
-            if typ == 3: # Deleted branch
-                pks = repo.packages_in_branch(line) or []
-                for pkg in pks:
-                    print("D "+line+"/"+pkg)
-                    index.delete_package(line, pkg)
-                    index.flush()
-            elif "/" in line:
-                time.sleep(1)
-                branch, package = map(str.strip, line.rsplit("/", 1))
+        changes, messages, received = receive_batch(queue, window,
+                                                    batch_size)
+        apply_batch(index, repo, changes, prewarm)
+
+        # Time between the first change arriving and it being committed
+        lag = time.time() - received
+
+        stats["messages"] += messages
+        stats["changes"] += len(changes)
+        stats["batches"] += 1
+        stats["max_batch"] = max(stats["max_batch"], len(changes))
+        stats["max_lag"] = max(stats["max_lag"], lag)
+
+        print("Batch of %d changes from %d messages, %d still queued, "
+              "lag %.2fs (max %.2fs), %d batches, average %.1f changes" % (
+              len(changes), messages, queue.current_messages, lag,
+              stats["max_lag"], stats["batches"],
+              float(stats["changes"]) / stats["batches"]))
+
+def get_prewarmer(repo, config):
+    """
+        Get an ArchivePrewarmer for the archive cache in the config,
+        or None if there is no archive cache.
+    """
+    from repo.archive import ArchiveCache, ArchivePrewarmer
 
-                if typ == 1: # Changed
-                    print("M "+branch+"/"+package)
-                    index.index_package(repo, branch, package)
-                    index.flush()
-                elif typ == 2: # Deleted
-                    print("D "+branch+"/"+package)
-                    index.delete_package(branch, package)
-                    index.flush()
-            else:
-                print("Error: `%s` is not a valid package.")
+    if "archive.cache" not in config:
+        return None
+
+    archives = ArchiveCache(config["archive.cache"],
+                            config.get("archive.cache_size", 1024*1024*1024))
+
+    return ArchivePrewarmer(repo, archives,
+                            config.get("archive.prewarm", ("tar.gz",)),
+                            config.get("archive.levels"),
+                            config.get("archive.workers", 1),
+                            config.get("archive.prewarm_queue", 256))
 
 def main():
     from repo.git import HurlGitRepo
+    from repo.config import load_config
 
     if len(sys.argv) < 3:
         print("USAGE: %s REPO DATABASE [COMMAND]" % sys.argv[0])
+        print("       %s REPO DATABASE reindex [WORKERS] [FLUSH]" % sys.argv[0])
+        print("       %s REPO DATABASE update" % sys.argv[0])
         return
 
     repo = HurlGitRepo(sys.argv[1])
+
+    if len(sys.argv) >= 4 and sys.argv[3] == "reindex":
+        workers = int(sys.argv[4]) if len(sys.argv) >= 5 else None
+        flush_every = int(sys.argv[5]) if len(sys.argv) >= 6 else 1000
+
+        rebuild(repo, sys.argv[2], workers, flush_every)
+        return
+
     index = HurlXapianIndex(sys.argv[2])
     index.create()
 
     if len(sys.argv) >= 4:
-        if sys.argv[3] == "reindex":
-            for branch in repo.get_branches():
-                for pkg in repo.packages_in_branch(branch):
-                    index.index_package(repo, branch, pkg)
+        if sys.argv[3] == "update":
+            changed, removed = index.update(repo)
+            print("%d reindexed, %d deleted" % (changed, removed))
         elif sys.argv[3] == "list":
-            index._connect_read()
-            for ident in index.conn.iterids():
+            for ident in index._connect_read().iterids():
                 print(ident)
         elif sys.argv[3] == "nop":
             return
     else:
-        listen(index, repo)
+        config = load_config()
+
+        listen(index, repo, prewarm=get_prewarmer(repo, config),
+               window=config.get("index.window", 2.0),
+               batch_size=config.get("index.batch_size", 1000))
 
 if __name__ == '__main__':
     main()
@@ -2,73 +2,79 @@ import os
 import yaml
 import cherrypy
 import tarfile
-import time
-from arch2cake import arch2cake, parse_pkgbuild, dump_cakefile
+
+from repo.arch import CakefileCache
+from repo.archive import GzipCompressor, ChunkSink, tar_blob, tar_path
 
 try:
     from yaml import CDumper as Dumper
 except ImportError:
     from yaml import Dumper
 
-try:
-    import cStringIO as StringIO
-except ImportError:
-    import StringIO
-
-def getcakefile(path):
-    # Converted cakefile
-    try:
-        output = StringIO.StringIO()
-
-        # Parse
-        with open(path, "r") as fd:
-            data = parse_pkgbuild(fd)
-
-        # Convert
-        data = arch2cake(data)
-
-        # Dump
-        dump_cakefile(data, output)
-
-        return output.getvalue()
-    except:
-        raise
-        return "An error occurred during PKGBUILD to Cakefile conversion."
+def stream_package(pkgroot, package, cakefile, mtime):
+    """
+        Generate a gzipped tar archive of an ABS package chunk by chunk,
+        with its PKGBUILD replaced by the converted Cakefile.
+        @param pkgroot: The absolute path of the package directory.
+        @param package: The name of the folder the files are put under.
+        @param cakefile: The converted Cakefile.
+        @param mtime: The timestamp given to the Cakefile.
+    """
+    sink = ChunkSink(GzipCompressor(9, mtime))
+    tarf = tarfile.open(fileobj=sink, mode="w|", format=tarfile.GNU_FORMAT)
+
+    # Add regular files
+    for fname in sorted(os.listdir(pkgroot)):
+        if fname != "PKGBUILD":
+            for chunk in tar_path(tarf, os.path.join(pkgroot, fname),
+                                  os.path.join(package, fname), sink):
+                yield chunk
+
+    # Add cakefile
+    info = tarfile.TarInfo(name=os.path.join(package, "Cakefile"))
+    info.size = len(cakefile)
+    info.mtime = int(mtime)
+    info.mode = 0o644
+
+    for chunk in tar_blob(tarf, info, cakefile, sink):
+        yield chunk
+
+    tarf.close()
+    sink.close()
+
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
 
 class Abs(object):
-    def __init__(self, repo, lookup):
+    def __init__(self, repo, lookup, catalog, cakefiles=None):
+        """
+            @param catalog: AbsCatalog of the ABS tree to list.
+            @param cakefiles: CakefileCache to get converted Cakefiles
+                from, defaults to one that is only kept in memory.
+        """
         self.repo, self.lookup = repo, lookup
+        self.catalog = catalog
+        self.cakefiles = cakefiles or CakefileCache()
 
     @cherrypy.expose
     def index(self):
-        absroot = cherrypy.request.app.config['arch']['absroot']
-
         return self.lookup.get_template("abs_repos.html").render(
-            repositories=[fld for fld in os.listdir(absroot)
-                       if os.path.isdir(os.path.join(absroot, fld))])
+            repositories=self.catalog.repositories())
 
     @cherrypy.expose
     def default(self, repo=None, package=None, filename=None):
         absroot = cherrypy.request.app.config['arch']['absroot']
 
         if package is None:
-            reporoot = os.path.join(absroot, repo)
+            packages = self.catalog.packages(repo)
 
-            # No updir allowed
-            if ".." in repo:
+            if packages is None:
                 raise cherrypy.NotFound()
 
-            # Get hurl-available packages
-            in_hurl = {}
-            for pkg in self.repo.get_packages():
-                in_hurl[pkg] = True
-
-            if os.path.exists(reporoot):
-                return self.lookup.get_template("abs_packages.html").render(
-                    repo=repo, packages=os.listdir(reporoot),
-                    in_hurl=in_hurl)
-            else:
-                raise CherryPy.NotFound()
+            return self.lookup.get_template("abs_packages.html").render(
+                repo=repo, packages=packages,
+                in_hurl=self.repo.package_names())
 
         if package.endswith(".tar.gz"):
             filename = package
@@ -79,10 +85,13 @@ class Abs(object):
             if ".." in repo or ".." in package:
                 raise cherrypy.NotFound()
 
-            pkgroot = os.path.join(absroot, repo, package)
+            files = self.catalog.files(repo, package)
+
+            if files is None:
+                raise cherrypy.NotFound()
 
             return self.lookup.get_template("abs_package.html").render(
-                repo=repo, package=package, files=os.listdir(pkgroot),
+                repo=repo, package=package, files=files,
                 available=self.repo.branches_with_package(package))
 
         pkgroot = os.path.join(absroot, repo, package)
@@ -103,39 +112,22 @@ class Abs(object):
         if filename == "Cakefile":
             # Show converted cakefile
             def stream():
-                yield getcakefile(os.path.join(pkgroot, "PKGBUILD"))
+                yield self.cakefiles.get(os.path.join(pkgroot, "PKGBUILD"))
             return stream()
         elif filename == package+".tar.gz":
-            # Create tar archive
-            content = StringIO.StringIO()
-            tarf = tarfile.open(fileobj=content, mode="w:gz")
+            pkgbuild = os.path.join(pkgroot, "PKGBUILD")
+            if not os.path.exists(pkgbuild):
+                raise cherrypy.NotFound()
+
+            # Convert before streaming, so errors still give a status
+            cakefile = self.cakefiles.get(pkgbuild)
+            mtime = os.stat(pkgbuild).st_mtime
 
             # Set MIME
             cherrypy.response.headers['Content-Type'] \
                 = 'application/x-tar-gz'
 
-            # Add regular files
-            os.chdir(os.path.join(absroot, repo))
-            for fname in os.listdir(pkgroot):
-                if fname != "PKGBUILD":
-                    tarf.add(os.path.join(package, fname))
-
-            # Add cakefile
-            data = getcakefile(os.path.join(pkgroot, "PKGBUILD"))
-
-            string = StringIO.StringIO()
-            string.write(data)
-            string.seek(0)
-
-            info = tarfile.TarInfo(name=os.path.join(package, "Cakefile"))
-            info.size = len(data)
-            info.mtime = time.time()
-
-            tarf.addfile(tarinfo=info, fileobj=string)
-
-            # Return data
-            tarf.close()
-            return content.getvalue()
+            return stream_package(pkgroot, package, cakefile, mtime)
 
         elif os.path.exists(filepath):
             # Stream single file
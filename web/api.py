@@ -4,22 +4,60 @@ import logging
 
 PROTOCOL_VER = 1.0
 
+# Maximum amount of results per search request
+SEARCH_LIMIT = 100
+
 class API(object):
-    def __init__(self, repo, lookup, index, access):
+    def __init__(self, repo, lookup, index, access, pages=None):
         self.repo, self.lookup, self.index, self.access = \
             repo, lookup, index, access
+        self.pages = pages
 
     @cherrypy.expose
     def version(self):
         return str(PROTOCOL_VER)
 
+    @cherrypy.expose
+    def stats(self):
+        stats = self.repo.cache_stats()
+
+        if self.pages is not None:
+            stats["pages"] = self.pages.stats()
+
+        return retdata(stats)
+
     @cherrypy.expose
     def sync(self):
         try:
             request = json.load(cherrypy.request.body)
+            epoch, generation = self.repo.get_generation()
             data = self.repo.get_latest_versions(request["data"])
 
-            return retdata(data)
+            return retdata(data, {"epoch": epoch, "generation": generation})
+        except:
+            logging.exception("JSON api error.")
+            return retdata(None, {"error": "Unexpected error."})
+
+    @cherrypy.expose
+    def changes(self):
+        try:
+            request = json.load(cherrypy.request.body)
+            data = request["data"]
+
+            epoch, generation, updated, removed = self.repo.get_changes(
+                data["epoch"], int(data["generation"]))
+
+            # Journal can't tell, client needs to do a full sync
+            if updated is None:
+                return retdata({"full": True},
+                    {"epoch": epoch, "generation": generation})
+
+            return retdata({
+                "full": False,
+                "updated": updated,
+                "removed": [{"branch": branch, "package": package}
+                            for branch, package in removed],
+            }, {"epoch": epoch, "generation": generation})
         except:
             logging.exception("JSON api error.")
             return retdata(None, {"error": "Unexpected error."})
@@ -28,15 +66,18 @@ class API(object):
     def search(self):
         try:
             request = json.load(cherrypy.request.body)
+            offset = max(int(request.get("offset", 0)), 0)
+            limit = min(max(int(request.get("limit", 10)), 1), SEARCH_LIMIT)
 
             # Search
-            results, num, exact = self.index.search(request["data"])
+            results, num, exact = self.index.search(request["data"],
+                                                    offset, limit)
 
             return retdata({
                 "count": num,
                 "is_exact": exact,
                 "results": list(results),
-            })
+            }, {"offset": offset, "limit": limit})
         except:
             logging.exception("JSON api error.")
             return retdata(None, {"error": "Unexpected error."})
@@ -1,16 +1,11 @@
 import cherrypy
 
-try:
-    import markdown
-    HAVE_MARKDOWN = True
-except ImportError:
-    HAVE_MARKDOWN = False
+LOG_ENTRIES = 20
 
 class Branch(object):
-    def __init__(self, repo, lookup):
-        self.repo, self.lookup = repo, lookup
-        self.md = markdown.Markdown(safe_mode="escape",
-            output_format="html")
+    def __init__(self, repo, lookup, pages, readmes):
+        self.repo, self.lookup, self.pages = repo, lookup, pages
+        self.readmes = readmes
 
     @cherrypy.expose
     def default(self, *branch):
@@ -18,13 +13,17 @@ class Branch(object):
             List all packages in a branch.
         """
         branch = "/".join(branch)
-        packages = self.repo.packages_in_branch(branch)
-        readme = None
+        head = self.repo.get_head(branch)
+
+        if head is None:
+            raise cherrypy.HTTPError(404)
 
-        if HAVE_MARKDOWN:
-            readme = self.repo.get_branch_readme(branch)
-            if readme:
-                readme = self.md.convert(readme)
+        return self.pages.serve("branch", (branch, head),
+            self.repo.get_head_mtime(branch), lambda: self.render(branch))
+
+    def render(self, branch):
+        packages = self.repo.packages_in_branch(branch)
+        readme = self.readmes.branch_readme(branch)
 
         if packages is None:
             raise cherrypy.HTTPError(404)
@@ -34,19 +33,32 @@ class Branch(object):
 
 
 class BranchLog(object):
-    def __init__(self, repo, lookup):
-        self.repo, self.lookup = repo, lookup
+    def __init__(self, repo, lookup, pages):
+        self.repo, self.lookup, self.pages = repo, lookup, pages
 
     @cherrypy.expose
-    def default(self, *branch):
+    def default(self, *branch, **kwargs):
         """
             Show a branch changelog.
         """
         branch = "/".join(branch)
-        log = self.repo.get_package_log(branch, None)
+        head = self.repo.get_head(branch)
+        after = kwargs.get("after")
+
+        if head is None:
+            raise cherrypy.HTTPError(404)
+
+        return self.pages.serve("branch-log", (branch, head, after),
+            self.repo.get_head_mtime(branch),
+            lambda: self.render(branch, after))
+
+    def render(self, branch, after):
+        log = self.repo.get_package_log(branch, None,
+            limit=LOG_ENTRIES+1, after=after)
 
         if log is None:
             raise cherrypy.HTTPError(404)
 
         return self.lookup.get_template("branch_log.html").render(
-            branch=branch, log=log[:20])
+            branch=branch, log=log[:LOG_ENTRIES],
+            more=len(log) > LOG_ENTRIES)
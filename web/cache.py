@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import email.utils
+import cherrypy
+from cherrypy.lib import httputil
+
+from repo.cache import LRUCache
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+def sizeof_page(page):
+    """
+        Estimate the memory used by a cached page.
+    """
+    return 200 + len(page[0]) + len(page[1])
+
+class PageCache(object):
+    def __init__(self, maxsize=32*1024*1024):
+        """
+            Cache of rendered pages, keyed on the view and the shas of
+            everything the page was rendered from. Also answers
+            conditional requests for them.
+            @param maxsize: The maximum amount of bytes to keep.
+        """
+        self.pages = LRUCache(maxsize, sizeof=sizeof_page)
+        self.lock = threading.Lock()
+
+        # view -> [hits, misses, not modified]
+        self.views = {}
+
+    def count(self, view, index):
+        """
+            Count a hit, miss or not modified response for a view.
+        """
+        with self.lock:
+            if view not in self.views:
+                self.views[view] = [0, 0, 0]
+            self.views[view][index] += 1
+
+    def serve(self, view, key, mtime, render):
+        """
+            Serve a page from the cache, rendering it if it isn't cached.
+            Responds with 304 Not Modified if the client has it already.
+            @param view: The name of the view rendering the page.
+            @param key: Tuple of the request arguments and the shas the
+                page is rendered from.
+            @param mtime: The commit time the page was last changed at,
+                or None if unknown.
+            @param render: Function rendering the page, either as a
+                string or as an iterable of chunks to stream.
+        """
+        etag = 'W/"%s"' % hashlib.sha1(repr((view, key))).hexdigest()
+
+        if not_modified(etag, mtime):
+            self.count(view, 2)
+            set_validators(etag, mtime)
+            raise cherrypy.HTTPRedirect([], 304)
+
+        page = self.pages.get((view, key))
+
+        if page is None:
+            self.count(view, 1)
+
+            body = render()
+            content_type = cherrypy.response.headers.get('Content-Type', "")
+            set_validators(etag, mtime)
+
+            if not isinstance(body, basestring):
+                return self.stream((view, key), content_type, body)
+
+            self.pages.put((view, key), (content_type, body))
+            return body
+
+        self.count(view, 0)
+
+        if page[0]:
+            cherrypy.response.headers['Content-Type'] = page[0]
+
+        set_validators(etag, mtime)
+        return page[1]
+
+    def stream(self, key, content_type, chunks):
+        """
+            Pass on the chunks of a page as they're rendered, caching
+            the page once all of them were.
+        """
+        body = []
+
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+
+        self.pages.put(key, (content_type, "".join(body)))
+
+    def stats(self):
+        """
+            Get the usage counters of the cache, including the hit
+            rate per view.
+        """
+        stats = self.pages.stats()
+        stats["views"] = {}
+
+        for view, (hits, misses, unmodified) in self.views.items():
+            stats["views"][view] = {
+                "hits": hits,
+                "misses": misses,
+                "not_modified": unmodified,
+                "hitrate": float(hits+unmodified) / (hits+misses+unmodified),
+            }
+
+        return stats
+
+def set_validators(etag, mtime):
+    """
+        Set the ETag and Last-Modified headers of the response.
+    """
+    cherrypy.response.headers['ETag'] = etag
+
+    if mtime is not None:
+        cherrypy.response.headers['Last-Modified'] = httputil.HTTPDate(mtime)
+
+def not_modified(etag, mtime):
+    """
+        Check if the conditional headers of the request say the client
+        already has a page.
+    """
+    match = cherrypy.request.headers.get('If-None-Match')
+
+    # If-Modified-Since is only used without If-None-Match
+    if match is not None:
+        tags = [tag.strip() for tag in match.split(",")]
+        return "*" in tags or etag in tags or etag[2:] in tags
+
+    since = cherrypy.request.headers.get('If-Modified-Since')
+    if since is None or mtime is None:
+        return False
+
+    parsed = email.utils.parsedate_tz(since)
+    if parsed is None:
+        return False
+
+    return int(mtime) <= email.utils.mktime_tz(parsed)
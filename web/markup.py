@@ -0,0 +1,75 @@
+import threading
+
+from repo.cache import LRUCache
+
+try:
+    import markdown
+    HAVE_MARKDOWN = True
+except ImportError:
+    HAVE_MARKDOWN = False
+
+class ReadmeRenderer(object):
+    def __init__(self, repo, maxsize=8*1024*1024):
+        """
+            Renders README files to HTML, caching the result by the sha
+            of their blob. Every thread converts with its own Markdown
+            instance, since those can't be shared.
+            @param maxsize: The maximum amount of bytes of HTML to keep.
+        """
+        self.repo = repo
+        self.html = LRUCache(maxsize, sizeof=len)
+        self.local = threading.local()
+
+    def markdown(self):
+        """
+            Get the Markdown instance of the current thread.
+        """
+        md = getattr(self.local, "md", None)
+
+        if md is None:
+            md = self.local.md = markdown.Markdown(safe_mode="escape",
+                output_format="html")
+        return md
+
+    def render(self, sha):
+        """
+            Get the HTML of the README in a blob, or None if it's empty
+            or Markdown isn't available.
+        """
+        if sha is None or not HAVE_MARKDOWN:
+            return None
+
+        html = self.html.get(sha)
+
+        if html is None:
+            text = self.repo[sha].as_raw_string()
+            if not text:
+                return None
+
+            md = self.markdown()
+            try:
+                html = md.convert(text)
+            finally:
+                md.reset()
+
+            self.html.put(sha, html)
+
+        return html
+
+    def branch_readme(self, branch):
+        """
+            Get the HTML of a branch README if it exists.
+        """
+        return self.render(self.repo.get_branch_readme_id(branch))
+
+    def package_readme(self, branch, package):
+        """
+            Get the HTML of a package's README if it exists.
+        """
+        return self.render(self.repo.get_package_readme_id(branch, package))
+
+    def stats(self):
+        """
+            Get the usage counters of the cache.
+        """
+        return self.html.stats()
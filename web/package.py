@@ -1,17 +1,22 @@
 import cherrypy
 import json
 
-try:
-    import markdown
-    HAVE_MARKDOWN = True
-except ImportError:
-    HAVE_MARKDOWN = False
+from repo.archive import MODES
+
+LOG_ENTRIES = 20
+
+def package_mtime(repo, branch, package):
+    """
+        Get the time the views of a package last changed, which doesn't
+        go back when its branch is reset to an older commit.
+    """
+    return max(repo.get_package_mtime(branch, package) or 0,
+               repo.get_head_seen(branch) or 0)
 
 class Package(object):
-    def __init__(self, repo, lookup):
-        self.repo, self.lookup = repo, lookup
-        self.md = markdown.Markdown(safe_mode="escape",
-            output_format="html")
+    def __init__(self, repo, lookup, pages, readmes):
+        self.repo, self.lookup, self.pages = repo, lookup, pages
+        self.readmes = readmes
 
     @cherrypy.expose
     def default(self, *ident, **kwargs):
@@ -19,67 +24,92 @@ class Package(object):
             # We only have a package name,
             # list all branches that have it
             package = ident[0]
-            branches = self.repo.branches_with_package(package)
 
-            if not branches:
-                raise cherrypy.NotFound()
-
-            return self.lookup.get_template("package_branches.html").render(
-                package=package, branches=branches)
+            return self.pages.serve("package-branches",
+                (package, self.repo.refs_snapshot().digest),
+                self.repo.get_refs_mtime(),
+                lambda: self.render_branches(package))
         else:
             # A fully qualified package was specified
             package = ident[-1]
             branch = "/".join(ident[:-1])
+            tree = self.repo.package_trees(package).get(branch)
+            as_json = kwargs.get("json") == "1"
+            as_text = kwargs.get("text") == "1"
+
+            if tree is None:
+                raise cherrypy.NotFound()
 
-            pkg = self.repo.get_package_cakefile(branch, package)
-            files = self.repo.get_package_files(branch, package)
-            readme = None
+            return self.pages.serve("package",
+                (branch, package, tree, as_json, as_text),
+                package_mtime(self.repo, branch, package),
+                lambda: self.render(branch, package, as_json, as_text))
 
-            if HAVE_MARKDOWN:
-                readme = self.repo.get_package_readme(branch, package)
-                if readme:
-                    readme = self.md.convert(readme)
+    def render_branches(self, package):
+        branches = self.repo.branches_with_package(package)
 
-            if pkg is None or files is None:
-                raise cherrypy.NotFound()
+        if not branches:
+            raise cherrypy.NotFound()
+
+        return self.lookup.get_template("package_branches.html").render(
+            package=package, branches=branches)
+
+    def render(self, branch, package, as_json, as_text):
+        pkg = self.repo.get_package_cakefile(branch, package)
+        files = self.repo.get_package_files(branch, package)
+        readme = self.readmes.package_readme(branch, package)
+
+        if pkg is None or files is None:
+            raise cherrypy.NotFound()
+
+        if as_json:
+            # List info in json format
+            if not as_text:
+                cherrypy.response.headers['Content-Type'] = \
+                    'application/json'
+            return json.dumps(pkg)
+
+        # Parse dependencies and sources
+        if "dependencies" in pkg:
+            pkg["dependencies"] = map(self.repo.parse_dependency,
+                                      pkg["dependencies"])
+
+        if "build-dependencies" in pkg:
+            pkg["build-dependencies"] = map(self.repo.parse_dependency,
+                                      pkg["build-dependencies"])
 
-            if "json" in kwargs and kwargs["json"] == "1":
-                # List info in json format
-                if "text" not in kwargs or kwargs["text"] != "1":
-                    cherrypy.response.headers['Content-Type'] = \
-                        'application/json'
-                return json.dumps(pkg)
-
-            # Parse dependencies and sources
-            if "dependencies" in pkg:
-                pkg["dependencies"] = map(self.repo.parse_dependency,
-                                          pkg["dependencies"])
-
-            if "build-dependencies" in pkg:
-                pkg["build-dependencies"] = map(self.repo.parse_dependency,
-                                          pkg["build-dependencies"])
-
-            if "sources" in pkg:
-                pkg["sources"] = [self.repo.parse_source(source, pkg=pkg)
-                                        for source in pkg["sources"]]
-
-            # List the package that's in the branch
-            return self.lookup.get_template("package.html").render(
-                branch=branch,
-                package=package,
-                pkg=pkg, files=files,
-                readme=readme)
+        if "sources" in pkg:
+            pkg["sources"] = [self.repo.parse_source(source, pkg=pkg)
+                                    for source in pkg["sources"]]
+
+        # List the package that's in the branch
+        return self.lookup.get_template("package.html").render(
+            branch=branch,
+            package=package,
+            pkg=pkg, files=files,
+            readme=readme, formats=sorted(MODES))
 
 class PackageLog(object):
-    def __init__(self, repo, lookup):
-        self.repo, self.lookup = repo, lookup
+    def __init__(self, repo, lookup, pages):
+        self.repo, self.lookup, self.pages = repo, lookup, pages
 
     @cherrypy.expose
-    def default(self, *ident):
+    def default(self, *ident, **kwargs):
         package = ident[-1]
         branch = "/".join(ident[:-1])
+        head = self.repo.get_head(branch)
+        after = kwargs.get("after")
+
+        if head is None:
+            raise cherrypy.NotFound()
+
+        return self.pages.serve("package-log", (branch, package, head, after),
+            package_mtime(self.repo, branch, package),
+            lambda: self.render(branch, package, after))
 
-        log = self.repo.get_package_log(branch, package)
+    def render(self, branch, package, after):
+        log = self.repo.get_package_log(branch, package,
+            limit=LOG_ENTRIES+1, after=after)
         pkg = self.repo.get_package_cakefile(branch, package)
 
         if pkg is None or log is None:
@@ -88,7 +118,8 @@ class PackageLog(object):
         return self.lookup.get_template("package_log.html").render(
             branch=branch,
             package=package,
-            pkg=pkg, log=log[:20])
+            pkg=pkg, log=log[:LOG_ENTRIES],
+            more=len(log) > LOG_ENTRIES)
 
 class PackageFile(object):
     def __init__(self, repo, lookup):
@@ -1,24 +1,74 @@
 import cherrypy
+import collections
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+PAGE_ENTRIES = 200
+
+# Packages rendered at a time when streaming the package list
+STREAM_ENTRIES = 50
+
+# Stands in for the package list when rendering the rest of the page
+LISTING = "<!-- listing -->"
 
 class Root(object):
-    def __init__(self, repo, lookup, index=None):
+    def __init__(self, repo, lookup, pages, index=None):
         self.repo, self.lookup, self._index = repo, lookup, index
+        self.pages = pages
 
     @cherrypy.expose
     def index(self):
         return self.lookup.get_template("index.html").render(
             numpackages=self._index.count() if self._index is not None else
-                        len(self.repo.get_packages()),
+                        self.repo.count_packages(),
             numbranches=self.repo.count_branches())
 
     @cherrypy.expose
-    def packages(self):
-        in_master = {}
-        for pkg in self.repo.packages_in_branch("master"):
-            in_master[pkg] = True
+    def packages(self, prefix=None, q=None, after=None):
+        return self.pages.serve("packages",
+            (prefix, q, after, self.repo.refs_snapshot().digest),
+            self.repo.get_refs_mtime(),
+            lambda: self.render_packages(prefix, q, after))
+    packages._cp_config = { "response.stream": True }
+
+    def render_packages(self, prefix, q, after):
+        """
+            Render a page of the package list, streaming the packages
+            in it a few at a time after the rest of the page.
+        """
+        packages, more = self.repo.get_packages_page(prefix, q, after,
+                                                     PAGE_ENTRIES)
+        next_page = None
+
+        if more:
+            args = [(key, value) for key, value in (("prefix", prefix),
+                    ("q", q)) if value]
+            next_page = urlencode(args + [("after", list(packages)[-1])])
+
+        template = self.lookup.get_template("packages.html")
+        head, tail = template.render(
+            count=self.repo.count_packages(),
+            initials=self.repo.get_package_initials(),
+            prefix=prefix, query=q, next=next_page,
+            listing=LISTING).split(LISTING, 1)
+
+        return self.stream_packages(template, head, packages, tail)
+
+    def stream_packages(self, template, head, packages, tail):
+        yield head
+
+        items = template.get_def("items")
+        names = list(packages)
+
+        for start in range(0, len(names), STREAM_ENTRIES):
+            yield items.render(packages=collections.OrderedDict(
+                (name, packages[name])
+                for name in names[start:start+STREAM_ENTRIES]))
 
-        return self.lookup.get_template("packages.html").render(
-            packages=self.repo.get_packages(), in_master=in_master)
+        yield tail
 
     @cherrypy.expose
     def branches(self):
@@ -2,17 +2,25 @@ import datetime
 import cherrypy
 from json import dumps
 
+RESULT_ENTRIES = 10
+
 class Search(object):
     def __init__(self, repo, lookup, index):
         self.repo, self.lookup, self.index = repo, lookup, index
 
     @cherrypy.expose
-    def default(self, q=None):
+    def default(self, q=None, offset="0"):
         if q is None:
             raise cherrypy.NotFound()
 
+        try:
+            offset = max(int(offset), 0)
+        except ValueError:
+            raise cherrypy.NotFound()
+
         # Search
-        results, num, exact = self.index.search(q)
+        results, num, exact = self.index.search(q, offset, RESULT_ENTRIES)
 
         return self.lookup.get_template("search.html").render(
-            results=results, num=num, exact=exact, query=q)
+            results=results, num=num, exact=exact, query=q,
+            offset=offset, limit=RESULT_ENTRIES)
@@ -1,37 +1,25 @@
-import dulwich
 import os
-import tarfile
 import cherrypy
-import time
+from cherrypy.lib.static import serve_fileobj
 
-try:
-    import cStringIO as StringIO
-except ImportError:
-    import StringIO
-
-def tar_tree(tarf, folder, repo, tree):
-    for i, filename, ident in tree.entries():
-        obj = repo[ident]
-
-        if isinstance(obj, dulwich.objects.Blob):
-            blob = obj.as_raw_string()
-            length = len(blob)
-
-            string = StringIO.StringIO()
-            string.write(blob)
-            string.seek(0)
-
-            info = tarfile.TarInfo(name=os.path.join(folder, filename))
-            info.size = length
-            info.mtime = time.time()
-
-            tarf.addfile(tarinfo=info, fileobj=string)
-        elif isinstance(obj, dulwich.objects.Tree):
-            tar_tree(tarf, os.path.join(folder, filename), repo, obj)
+from repo.archive import MODES, package_archive
 
 class Source(object):
-    def __init__(self, repo, lookup):
+    def __init__(self, repo, lookup, archives=None, sendfile=None,
+                 levels=None, workers=1):
+        """
+            @param archives: ArchiveCache to serve archives from, or
+                None to build every archive on request.
+            @param sendfile: A (header, prefix) pair, to have the front-end
+                server send cached archives, like
+                ("X-Accel-Redirect", "/archives/").
+            @param levels: Compression level per archive type, like
+                {"tar.gz": 6}. Types not in it use their default level.
+            @param workers: Compress archives on this many threads.
+        """
         self.repo, self.lookup = repo, lookup
+        self.archives, self.sendfile = archives, sendfile
+        self.levels, self.workers = levels or {}, workers
 
     @cherrypy.expose
     def default(self, *ident):
@@ -45,30 +33,42 @@ class Source(object):
         if not filename.startswith(brident) or ".tar." not in filename:
             raise cherrypy.NotFound()
 
-        package, _ = filename[len(brident)+1:].rsplit(".tar.", 1)
+        package, ext = filename[len(brident)+1:].rsplit(".tar.", 1)
+        ext = "tar."+ext
 
         # Extract archive type
-        if filename.endswith(".tar.gz"):
-            cherrypy.response.headers['Content-Type'] \
-                = 'application/x-tar-gz'
+        if ext not in MODES:
+            raise cherrypy.NotFound()
 
-            mode = "w:gz"
-        elif filename.endswith(".tar.bz2"):
-            cherrypy.response.headers['Content-Type'] \
-                = 'application/x-tar-bz2'
+        mime = MODES[ext].mime
+        archive = package_archive(self.repo, branch, package, ext,
+                                  self.levels.get(ext), self.workers)
 
-            mode = "w:bz2"
-        else:
+        if archive is None:
             raise cherrypy.NotFound()
 
-        # Create tar archive
-        content = StringIO.StringIO()
-        tarf = tarfile.open(fileobj=content, mode=mode)
-        tree = self.repo.get_package_tree(branch, package)
+        name, build = archive
+        etag = '"%s"' % name
 
-        if tree is None:
-            raise cherrypy.NotFound()
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Content-Type'] = mime
+
+        match = cherrypy.request.headers.get('If-None-Match')
+        if match is not None and (match.strip() == "*" or
+           etag in [tag.strip() for tag in match.split(",")]):
+            raise cherrypy.HTTPRedirect([], 304)
+
+        if self.archives is None:
+            # Stream the archive as it's compressed
+            return build()
+
+        if self.sendfile is not None:
+            # Let the front-end server send it
+            path = self.archives.get(name, ext, build)
+            header, prefix = self.sendfile
+            cherrypy.response.headers[header] = prefix+os.path.basename(path)
+            return ""
 
-        tar_tree(tarf, brident+"-"+package, self.repo, tree)
-        tarf.close()
-        return content.getvalue()
+        return serve_fileobj(self.archives.get_file(name, ext, build),
+                             content_type=mime)
+    default._cp_config = { "response.stream": True }